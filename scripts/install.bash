@@ -349,6 +349,8 @@ if [ ! -f "${config_encrypted_path}" ]; then
 	cp ../src/config_encrypted.defaults.py "${config_encrypted_path}"
 else
 	echo 'Encrypted configuration file already exists, continuing...'
+	echo 'Settings added in newer versions of EncroCam that are missing from it use their'
+	echo 'default value; see src/config_encrypted.defaults.py to change them.'
 fi
 
 if [[ "${SHELL}" =~ 'bash' ]]; then
@@ -5,6 +5,7 @@ source common.sh
 
 screen_session_name="$(getConfig 'screen_session_name')"
 
+pkill -f supervisor.py  # first, or it would restart record.py
 pkill -f record.py
 pkill -f sync.py
 
@@ -0,0 +1,100 @@
+#!/usr/bin/env bash
+
+# $0 [gapless|restart]
+# Measures how much video is lost when record.py starts a new file, with either setting of gapless_rotation.
+# Needs ffmpeg and gpg, but no camera: record.py's ffmpeg is given a test pattern (lavfi testsrc) as input instead.
+# Takes about a minute. Everything is done in a temporary directory.
+
+mode=${1:-gapless}
+if [ "$mode" == gapless ]; then
+	gapless=True
+elif [ "$mode" == restart ]; then
+	gapless=False
+else
+	echo "Usage: $0 [gapless|restart]"
+	exit 1
+fi
+
+src=$(realpath "$(dirname "$0")/../src")
+real_ffmpeg=$(command -v ffmpeg) || { echo 'ffmpeg not found'; exit 1; }
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+mkdir -p "$tmp/encrypted_mountpoint/gpg_homedir" "$tmp/scripts" "$tmp/recordings" "$tmp/bin"
+chmod 700 "$tmp/encrypted_mountpoint/gpg_homedir"
+
+# Throwaway key that both signs and encrypts
+export GNUPGHOME="$tmp/encrypted_mountpoint/gpg_homedir"
+gpg --batch --quiet --passphrase '' --quick-gen-key rotation-test@encrocam.invalid future-default default never 2>/dev/null
+fpr=$(gpg --list-keys --with-colons | awk -F: '/^fpr/ { print $10; exit }')
+
+# New file every 20 seconds
+sed -e 's/^\(\s*hours_per_recording\) = .*/\1 = 20 \/ 3600/' -e "s/^\(\s*gapless_rotation\) = .*/\1 = $gapless/" \
+	"$src/config_encrypted.defaults.py" > "$tmp/encrypted_mountpoint/config.py"
+
+# Stand-in for ffmpeg: replaces the camera input (everything up to and including -i <device>) by a real-time test
+# pattern, drops the drawtext filter (not every ffmpeg build has it), and logs when it started
+cat > "$tmp/bin/ffmpeg" <<EOF
+#!/usr/bin/env bash
+date +%s.%N >> "$tmp/ffmpeg-starts"
+while [ "\$1" != -i ]; do shift; done; shift 2
+args=()
+while [ \$# -gt 0 ]; do
+	if [ "\$1" == -vf ]; then shift 2; continue; fi
+	args+=("\$1"); shift
+done
+exec "$real_ffmpeg" -loglevel error -f lavfi -i 'testsrc=rate=30:size=320x240,realtime' "\${args[@]}"
+EOF
+chmod +x "$tmp/bin/ffmpeg"
+
+cd "$tmp/scripts"
+PATH="$tmp/bin:$PATH" python3 "$src/record.py" "$tmp" "$fpr" "$fpr" "$tmp/recordings" > "$tmp/record.log" 2>&1 &
+record_pid=$!
+# Wait until the second file has been written to for a while
+while [ "$(ls "$tmp/recordings" | wc -l)" -lt 2 ]; do
+	kill -0 $record_pid 2>/dev/null || { echo 'record.py exited'; cat "$tmp/record.log"; exit 1; }
+	sleep 1
+done
+sleep 12
+pkill -P $record_pid
+kill $record_pid
+wait 2>/dev/null
+cat "$tmp/record.log"
+
+# Video frame timestamps in seconds, from the start of the ffmpeg process that recorded them: the PTS of each video PES
+# packet in the MPEG transport stream, skipping over the playlists that ffmpeg writes between the HLS segments
+frametimes() {
+	python3 "$src/decrypter.py" "$1" "$1.hls" "$fpr" > /dev/null 2>&1
+	python3 - "$1.hls" <<'EOF'
+import sys
+data = open(sys.argv[1], 'rb').read()
+i = 0
+while i + 188 <= len(data):
+    if data[i] != 0x47 or (i + 188 < len(data) and data[i + 188] != 0x47):
+        i += 1
+        continue
+    packet = data[i : i + 188]
+    i += 188
+    if not packet[1] & 0x40:  # not the start of a PES packet
+        continue
+    pes = packet[4 + (packet[4] + 1 if packet[3] & 0x20 else 0) : ]  # skip the adaptation field, if any
+    if pes[0 : 3] == b'\x00\x00\x01' and pes[3] & 0xf0 == 0xe0 and pes[7] & 0x80:  # video stream with a PTS
+        pts = (pes[9] >> 1 & 7) << 30 | pes[10] << 22 | pes[11] >> 1 << 15 | pes[12] << 7 | pes[13] >> 1
+        print(pts / 90000)
+EOF
+}
+files=($(ls "$tmp/recordings" | sort | head -2))
+last=$(frametimes "$tmp/recordings/${files[0]}" | sort -n | tail -1)
+first=$(frametimes "$tmp/recordings/${files[1]}" | sort -n | head -1)
+starts=($(cat "$tmp/ffmpeg-starts"))
+if [ $gapless == True ]; then
+	start1=${starts[0]}; start2=${starts[0]}
+else
+	start1=${starts[0]}; start2=${starts[1]}
+fi
+
+# Startup delays are about equal for each ffmpeg process, so the wall-clock time of a frame is its timestamp plus
+# the time the process started, give or take. The gap is the time between frames beyond the 1/30 s frame interval.
+python3 -c "
+gap = ($start2 + $first) - ($start1 + $last) - 1 / 30
+print(f'Gap between {\"${files[0]}\"} and {\"${files[1]}\"}: {max(0, gap):.3f} seconds ({max(0, round(gap * 30))} frames)')
+"
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import sys, os, struct, time  # stdlib imports
+import sys, os, io, zlib, json, struct, time, hashlib, collections, threading, concurrent.futures  # stdlib imports
 import gnupg
 from Cryptodome.Cipher import AES
 
@@ -16,220 +16,897 @@ def timefmt(timestamp):
     return time.strftime("%a %H:%M", time.localtime(timestamp))
 
 
+class KeyCache:
+    """
+    Least-recently-used cache of symmetric keys that were unwrapped from key packets, so each key packet only needs
+    GnuPG (a process spawn and a private key operation) once. Entries are keyed by a hash of the signing fingerprint and
+    the key packet, and only keys whose signature checked out are added.
+    Memory-only by default; load() and save() keep it in a file that is encrypted and signed with PGP, so that it can be
+    reused across runs of the decrypter for the price of one GnuPG call. Can be shared between threads.
+    """
+
+    MAGIC = b'EncroKeyCache1\n'
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.modified = False
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def cache_key(signing_fingerprint, packet_data):
+        return hashlib.sha256(signing_fingerprint.encode('ascii') + b'\0' + packet_data).digest()
+
+
+    def get(self, cache_key):
+        with self.lock:
+            key = self.entries.get(cache_key)
+            if key is not None:
+                self.entries.move_to_end(cache_key)
+            return key
+
+
+    def put(self, cache_key, key):
+        with self.lock:
+            self.entries[cache_key] = key
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.modified = True
+
+
+    def load(self, path, gpg, signer):
+        """
+        keycache_obj.load(string, gnupg.GPG object, string)
+        Adds the entries from a cache file written by save() with the same fingerprint. A missing file is not an error:
+        there is nothing cached yet. The file must be signed by that key: anyone with the public key could encrypt a
+        cache file, and a cached key is trusted without checking the key packet's signature, so an unsigned file would
+        let them pass off forged recordings as verified.
+        """
+        try:
+            with open(path, 'rb') as f:
+                decrypted = gpg.decrypt_file(f)
+        except FileNotFoundError:
+            return
+        if not decrypted.ok or not decrypted.data.startswith(KeyCache.MAGIC):
+            warn(f'Ignoring key cache {path}: could not decrypt it ({decrypted.status})')
+            return
+        if not decrypted.valid or signer not in [decrypted.fingerprint, getattr(decrypted, 'pubkey_fingerprint', None)]:
+            warn(f'Ignoring key cache {path}: not signed by {signer} (signed by {decrypted.fingerprint})')
+            return
+
+        data = decrypted.data[len(KeyCache.MAGIC) : ]
+        entry_length = 32 + EncroCrypt.LENGTH_ENCRYPTION_KEY
+        for pos in range(0, len(data) - entry_length + 1, entry_length):
+            self.entries[data[pos : pos + 32]] = data[pos + 32 : pos + entry_length]
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+    def save(self, path, gpg, recipient):
+        """
+        keycache_obj.save(string, gnupg.GPG object, string)
+        Writes the cache to a file, encrypted for and signed by the given fingerprint (so it needs that secret key, like
+        load() does). Does nothing if no entries were added.
+        """
+        if not self.modified:
+            return
+        plaintext = KeyCache.MAGIC + b''.join(cache_key + key for cache_key, key in self.entries.items())
+        result = gpg.encrypt(plaintext, recipients=[recipient], sign=recipient, armor=False)
+        if not result.ok:
+            warn(f'Could not save key cache {path}: encryption failed ({result.status})')
+            return
+        tmppath = path + '.tmp'
+        with open(tmppath, 'wb') as f:
+            f.write(result.data)
+        os.replace(tmppath, path)
+        self.modified = False
+
+
+class KeyPool:
+    """
+    Keeps `size` new symmetric keys with their key packets ready, wrapped by GnuPG on a background thread. Wrapping a
+    key means spawning GnuPG for a public key encryption and a signature, which takes long enough that ffmpeg's output
+    piles up while the recorder waits for it. EncroCrypt objects that are given a pool take their keys from it instead.
+    Also keeps count of how long wrapping took and how often (and how long) get() had to wait for a key. If given,
+    on_wrap is called with the number of seconds every time a key was wrapped.
+    """
+
+    def __init__(self, signing_fingerprint, encrypt_fingerprint, gnupghome=None, size=1, on_wrap=None):
+        self.gpg = gnupg.GPG(gnupghome=gnupghome)
+        self.signing_fingerprint = signing_fingerprint
+        self.encrypt_fingerprint = encrypt_fingerprint
+        self.size = size
+        self.on_wrap = on_wrap
+        self.ready = collections.deque()  # (key, key packet data)
+        self.error = None  # exception from wrapping, raised by the next get()
+        self.condition = threading.Condition()
+        self.reset_stats()
+        threading.Thread(target=self._fill, daemon=True).start()
+
+
+    def reset_stats(self):
+        self.wraps = 0
+        self.wrap_seconds = 0
+        self.wrap_seconds_max = 0
+        self.waits = 0
+        self.wait_seconds = 0
+
+
+    def _fill(self):
+        while True:
+            with self.condition:
+                while len(self.ready) >= self.size or self.error is not None:
+                    self.condition.wait()
+
+            start = time.perf_counter()
+            try:
+                pair = EncroCrypt.wrap_new_key(self.gpg, self.signing_fingerprint, self.encrypt_fingerprint)
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                continue
+            seconds = time.perf_counter() - start
+            if self.on_wrap is not None:
+                self.on_wrap(seconds)
+
+            with self.condition:
+                self.ready.append(pair)
+                self.wraps += 1
+                self.wrap_seconds += seconds
+                self.wrap_seconds_max = max(self.wrap_seconds_max, seconds)
+                self.condition.notify_all()
+
+
+    def get(self):
+        """
+        keypool_obj.get() -> (bytes, bytes)
+        Returns a key and the data for its key packet, waiting for one to be wrapped if none is ready. Raises the
+        exception if wrapping failed; the next call tries again.
+        """
+        with self.condition:
+            if len(self.ready) == 0 and self.error is None:
+                self.waits += 1
+                start = time.perf_counter()
+                while len(self.ready) == 0 and self.error is None:
+                    self.condition.wait()
+                self.wait_seconds += time.perf_counter() - start
+
+            self.condition.notify_all()  # let _fill() top it up again
+            if len(self.ready) > 0:
+                return self.ready.popleft()
+            error = self.error
+            self.error = None
+            raise error
+
+
+class FollowReader:
+    """
+    Wraps a file that is still being written to (like the current recording, or its copy on the FTP server) such that
+    reading at its end waits for more data instead of returning EOF, like `tail -f`. Checks every `interval` seconds.
+    on_wait, if given, is called before waiting, e.g. EncroCrypt.flush_output so everything up to here is written out.
+    Reading returns EOF only if the file was truncated (replaced by something shorter).
+    """
+
+    def __init__(self, stream, interval=0.5, on_wait=None):
+        self.stream = stream
+        self.interval = interval
+        self.on_wait = on_wait
+
+
+    def read(self, size=-1):
+        while True:
+            data = self.stream.read(size)  # a regular file returns new data at what used to be its end
+            if data:
+                return data
+            if os.fstat(self.stream.fileno()).st_size < self.stream.tell():
+                warn('File was truncated, stopping')
+                return b''
+            if self.on_wait is not None:
+                self.on_wait()
+            time.sleep(self.interval)
+
+
+    read1 = read
+
+
+    def tell(self):
+        return self.stream.tell()
+
+
 class EncroCrypt:
     MAGIC = b'__EncroCrypt2'  # Appears in front of every packet, long enough not to randomly occur in encrypted data before the Sun burns out
+    MAGIC3 = b'__EncroCrypt3'  # Same, for packets in the version 3 framing (see LENGTH_HEADER3)
+    MAGIC_PREFIX = b'__EncroCrypt'  # what the magic strings of all versions start with, for finding either
 
     LENGTH_ENCRYPTION_KEY = 16
-    LENGTH_NONCE          = 16
+    LENGTH_NONCE          = 16  # random nonces in PACKET_VIDEODATA
+    LENGTH_COUNTER_NONCE  = 12  # nonce prefix + counter in PACKET_VIDEODATA_COUNTER
+    LENGTH_NONCE_PREFIX   = 8
     LENGTH_MAC            = 16
-    MAX_GCM_INVOCATIONS   = int(2**32)  # per NIST SP 800-38d, page 21, the paragraph in bold text
+    MAX_GCM_INVOCATIONS   = int(2**32)  # per NIST SP 800-38d, page 21, the paragraph in bold text. Also exactly the 4-byte counter's range
 
-    PACKET_NEWKEY    = b'\x01'
-    PACKET_VIDEODATA = b'\x02'
+    PACKET_NEWKEY            = b'\x01'
+    PACKET_VIDEODATA         = b'\x02'  # random nonce per packet; no longer written but still decrypted
+    PACKET_VIDEODATA_COUNTER = b'\x03'  # nonce is a random per-key prefix plus a packet counter
+    PACKET_METADATA          = b'\x04'  # same as PACKET_VIDEODATA_COUNTER (and sharing its counter), but the plaintext is JSON about the video, see encrypt_metadata()
 
     PACKET_MAXLENGTH = 1024 * 1024 * 10
 
+    LENGTH_HEADER = len(MAGIC) + 1 + 4  # magic, packet type, packet length
+
+    # Version 3 framing: after the magic come the packet type, packet length, sequence number (counting all packets
+    # written by one EncroCrypt object, starting at 0), and the minute (unix timestamp // 60), followed by a CRC-32 of
+    # those fields. A header that passes the CRC can be trusted to say where the next packet starts, so the decrypter
+    # does not have to search the data for magic strings. For video data and metadata packets, the fields are also
+    # authenticated along with the ciphertext (as GCM associated data), and the timestamp is no longer part of the data.
+    struct_header3 = struct.Struct(">cIII")
+    LENGTH_HEADER3 = len(MAGIC3) + struct_header3.size + 4
+    READ_HEADER = max(LENGTH_HEADER + 4, LENGTH_HEADER3)  # enough bytes for parse_header() to find the timestamp in either version
+
+    FRAMING = 3  # the version written when encrypting
+
+    STREAM_CHUNK = 1024 * 1024  # how much the decrypter reads at a time
+
     struct_int = struct.Struct(">I")
 
-    def __init__(self, signing_fingerprint, encrypt_fingerprint=None, gnupghome=None):
+    def __init__(self, signing_fingerprint, encrypt_fingerprint=None, gnupghome=None, key_cache=None, key_pool=None):
         """
-        encrocrypt_obj = EncroCrypt(string, string or None, string or None)
+        encrocrypt_obj = EncroCrypt(string, string or None, string or None, KeyCache or None, KeyPool or None)
         encrypt_fingerprint is only required when encrypting (fingerprint of the key used to encrypt)
+        key_cache is optional and only used when decrypting; it can be shared between EncroCrypt objects
+        key_pool is optional and only used when encrypting; it can be shared between EncroCrypt objects
         """
         self.gpg = gnupg.GPG(gnupghome=gnupghome)
         self.encrypt_fingerprint = encrypt_fingerprint
         self.signing_fingerprint = signing_fingerprint
         self.key = None
+        self.pending_key_packet = None  # key packet that still needs to be written before the next video data
         self.showed_data_before_key_warning = False
+        self.packet_buffer = None
+        self.expected_nonce = None  # (prefix, counter) of the next video packet, when decrypting
+        self.key_cache = key_cache
+        self.key_pool = key_pool
+        self.packets_encrypted = 0  # video data and metadata packets, for statistics
+        self.framing = EncroCrypt.FRAMING  # 2 writes the old framing instead, e.g. to compare them in benchmark.py
+        self.sequence = 0  # of the next packet written, in the version 3 framing
+        self.expected_sequence = None  # of the next packet, when decrypting
+        self.verbose = True  # print problems and progress while decrypting; they are counted in self.problems either way
 
 
     def _pack(self, packet_type, data):
-        return EncroCrypt.MAGIC + packet_type + EncroCrypt.struct_int.pack(len(data)) + data
+        if self.framing == 2:
+            return EncroCrypt.MAGIC + packet_type + EncroCrypt.struct_int.pack(len(data)) + data
+        fields = EncroCrypt.struct_header3.pack(packet_type, len(data), self.sequence, int(time.time() / 60))
+        self.sequence += 1
+        return EncroCrypt.MAGIC3 + fields + EncroCrypt.struct_int.pack(zlib.crc32(fields)) + data
 
 
-    def _new_symmetric_key(self):
-        self.key = os.urandom(EncroCrypt.LENGTH_ENCRYPTION_KEY)
-        self.gcm_invocations_with_same_key = 0
+    @staticmethod
+    def parse_header(data):
+        """
+        EncroCrypt.parse_header(bytes) -> (bytes, int, int or None, int) or None
+        Parses the packet header at the start of data, which should be READ_HEADER bytes long (or as much as the file
+        has). Returns the packet type, packet length, minute (unix timestamp // 60; None for key packets in the version
+        2 framing), and header length, or None if data does not start with a valid header of either version.
+        """
+        if data.startswith(EncroCrypt.MAGIC3):
+            if len(data) < EncroCrypt.LENGTH_HEADER3:
+                return None
+            fields = data[len(EncroCrypt.MAGIC3) : EncroCrypt.LENGTH_HEADER3 - 4]
+            if zlib.crc32(fields) != EncroCrypt.struct_int.unpack_from(data, EncroCrypt.LENGTH_HEADER3 - 4)[0]:
+                return None
+            packet_type, packet_length, sequence, minute = EncroCrypt.struct_header3.unpack(fields)
+            if packet_length > EncroCrypt.PACKET_MAXLENGTH:
+                return None
+            return packet_type, packet_length, minute, EncroCrypt.LENGTH_HEADER3
+
+        if data.startswith(EncroCrypt.MAGIC):
+            if len(data) < EncroCrypt.LENGTH_HEADER:
+                return None
+            packet_type = data[len(EncroCrypt.MAGIC) : len(EncroCrypt.MAGIC) + 1]
+            packet_length = EncroCrypt.struct_int.unpack_from(data, len(EncroCrypt.MAGIC) + 1)[0]
+            if packet_length > EncroCrypt.PACKET_MAXLENGTH or packet_length < 4:
+                return None
+            minute = None
+            if packet_type in [EncroCrypt.PACKET_VIDEODATA, EncroCrypt.PACKET_VIDEODATA_COUNTER, EncroCrypt.PACKET_METADATA] and len(data) >= EncroCrypt.LENGTH_HEADER + 4:
+                minute = EncroCrypt.struct_int.unpack_from(data, EncroCrypt.LENGTH_HEADER)[0]
+            return packet_type, packet_length, minute, EncroCrypt.LENGTH_HEADER
+
+        return None
+
+
+    def _workspace(self):
+        # One reusable buffer that a complete video packet is assembled in, so encrypt_into() does not need to allocate
+        # (and copy into) a new bytes object for every header, ciphertext, and concatenation along the way
+        if self.packet_buffer is None:
+            self.packet_buffer = bytearray(EncroCrypt.READ_HEADER + EncroCrypt.LENGTH_COUNTER_NONCE + EncroCrypt.PACKET_MAXLENGTH + EncroCrypt.LENGTH_MAC)
+        return memoryview(self.packet_buffer)
+
+
+    @staticmethod
+    def wrap_new_key(gpg, signing_fingerprint, encrypt_fingerprint):
+        """
+        EncroCrypt.wrap_new_key(gnupg.GPG, string, string) -> (bytes, bytes)
+        Generates a symmetric key and returns it along with the data for its key packet (the key encrypted and signed
+        with PGP)
+        """
+        key = os.urandom(EncroCrypt.LENGTH_ENCRYPTION_KEY)
 
         # If signing_fingerprint is not found or invalid, GnuPG will use another available secret key. The python bindings don't have a way to force using a certain fingerprint.
         # This should not be an issue for us because the GnuPG homedir is in EncroCam's encrypted partition, so it should contain no other secret keys.
-        result = self.gpg.encrypt(data=self.key, recipients=[self.encrypt_fingerprint], sign=self.signing_fingerprint, armor=False)
+        result = gpg.encrypt(data=key, recipients=[encrypt_fingerprint], sign=signing_fingerprint, armor=False)
         if not result.ok:
             raise Exception('Encryption failed. Is the GnuPG home directory set correctly, the key fingerprints configured, and the encryption key verified/signed?')
 
-        return self._pack(EncroCrypt.PACKET_NEWKEY, result.data)
+        return key, result.data
+
+
+    def _new_symmetric_key(self):
+        if self.key_pool is not None:
+            key, wrapped = self.key_pool.get()
+        else:
+            key, wrapped = EncroCrypt.wrap_new_key(self.gpg, self.signing_fingerprint, self.encrypt_fingerprint)
+        packet = self._pack(EncroCrypt.PACKET_NEWKEY, wrapped)  # here rather than in the pool: the header has our sequence number
+
+        # Only start using the key once its key packet exists, or a failure would leave us encrypting with a key that is never written
+        self.key = key
+        self.nonce_prefix = os.urandom(EncroCrypt.LENGTH_NONCE_PREFIX)
+        self.gcm_invocations_with_same_key = 0
+        return packet
+
+
+    def prepare_key(self):
+        """
+        encrocrypt_obj.prepare_key()
+        Generates the first symmetric key and its key packet now instead of on the first encrypt call, because GnuPG
+        takes a while. The key packet is still written in front of the first video data. Can run on another thread,
+        as long as it is finished before the first encrypt call.
+        """
+        if self.key is None:
+            self.pending_key_packet = self._new_symmetric_key()
 
 
     def encrypt(self, data):
         """
-        encrocrypt_obj.encrypt(bytes object)
+        encrocrypt_obj.encrypt(bytes-like object)
         Returns the ciphertext as bytes object; potentially preceded by a new key packet if a new encryption key is needed.
+        See encrypt_into() for writing to a file without building the output in memory first.
+        """
+
+        output = io.BytesIO()
+        self.encrypt_into(data, output)
+        return output.getvalue()
+
+
+    def encrypt_metadata(self, metadata, out):
+        """
+        encrocrypt_obj.encrypt_metadata(dict, file object)
+        Writes a metadata packet to `out`: the dict as JSON, encrypted and authenticated like video data, with the same
+        key. record.py uses it for the activity score, e.g. {'start': 1736107200.0, 'seconds': 10.0, 'activity': 0.03,
+        'frames': 300}. Returns the number of bytes written.
+        """
+        return self.encrypt_into(json.dumps(metadata).encode(), out, EncroCrypt.PACKET_METADATA)
+
+
+    def encrypt_into(self, data, out, packet_type=PACKET_VIDEODATA_COUNTER):
+        """
+        encrocrypt_obj.encrypt_into(bytes-like object, file object, bytes)
+        Like encrypt(), but accepts any bytes-like object (bytes, bytearray, memoryview) and writes the packets directly
+        to `out` (anything with a write() method) instead of returning them. The input is sliced without copying and
+        each packet is encrypted straight into a reusable buffer, so the only copies are the encryption itself and
+        whatever `out` does with the data. Returns the number of bytes written.
         """
 
-        output = b''
+        data = memoryview(data).cast('B')
+        written = 0
 
         if self.key is None:
-            output += self._new_symmetric_key()
+            self.prepare_key()
+        if self.pending_key_packet is not None:
+            written += out.write(self.pending_key_packet)
+            self.pending_key_packet = None
 
-        while len(data) > 0:
-            if self.gcm_invocations_with_same_key > EncroCrypt.MAX_GCM_INVOCATIONS:
-                output += self._new_symmetric_key()
+        workspace = self._workspace()
+        offset = 0
+        while offset < len(data):
+            if self.gcm_invocations_with_same_key >= EncroCrypt.MAX_GCM_INVOCATIONS:
+                written += out.write(self._new_symmetric_key())
+
+            plaintext = data[offset : offset + EncroCrypt.PACKET_MAXLENGTH]
+            offset += len(plaintext)
 
-            timestamp = EncroCrypt.struct_int.pack(int(time.time() / 60))
-            nonce = os.urandom(EncroCrypt.LENGTH_NONCE)
             # Newly configure the cipher every time because we want message authentication on each small
             # part instead of having a cut-off file with missing authentication on the last few minutes.
             # A rolling MAC would be better, so that we can add the updated tag without having to also
-            # generate and add a new nonce every time, and it might be better to do nonce=nonce+1%maxuint
-            # instead of reading urandom all day long, but pycryptodome tells you to do it this way and
-            # NIST says it's fine for >=96 bits as well, so to avoid needing to validate this idea we've
-            # gone with the default recommendation. It does still seem like the better idea though, also
-            # based on <https://words.filippo.io/dispatches/xaes-256-gcm-11/>. Future work...
+            # generate and add a new nonce every time. The nonce is the deterministic construction from
+            # NIST SP 800-38d section 8.2.1: a random prefix that is fixed per key, followed by a counter
+            # that never repeats because we switch keys before it wraps (see MAX_GCM_INVOCATIONS). The
+            # 96-bit length also lets GCM use the nonce as-is instead of GHASHing it into the initial
+            # counter block, which saves a GHASH key setup per packet on top of not reading urandom.
+            nonce = self.nonce_prefix + EncroCrypt.struct_int.pack(self.gcm_invocations_with_same_key)
             cipher = AES.new(mode=AES.MODE_GCM, key=self.key, nonce=nonce)
-            ciphertext, mac = cipher.encrypt_and_digest(data[ : EncroCrypt.PACKET_MAXLENGTH])
             self.gcm_invocations_with_same_key += 1
-            output += self._pack(EncroCrypt.PACKET_VIDEODATA, timestamp + nonce + ciphertext + mac)
+            self.packets_encrypted += 1
+
+            if self.framing == 2:
+                # Packet layout: header | timestamp | nonce | ciphertext | mac
+                payload_length = 4 + EncroCrypt.LENGTH_COUNTER_NONCE + len(plaintext) + EncroCrypt.LENGTH_MAC
+                pos = EncroCrypt.LENGTH_HEADER
+                workspace[0 : len(EncroCrypt.MAGIC)] = EncroCrypt.MAGIC
+                workspace[len(EncroCrypt.MAGIC) : len(EncroCrypt.MAGIC) + 1] = packet_type
+                EncroCrypt.struct_int.pack_into(workspace, len(EncroCrypt.MAGIC) + 1, payload_length)
+                EncroCrypt.struct_int.pack_into(workspace, pos, int(time.time() / 60))
+                pos += 4
+            else:
+                # Packet layout: header (with the timestamp) | nonce | ciphertext | mac
+                payload_length = EncroCrypt.LENGTH_COUNTER_NONCE + len(plaintext) + EncroCrypt.LENGTH_MAC
+                pos = EncroCrypt.LENGTH_HEADER3
+                workspace[0 : len(EncroCrypt.MAGIC3)] = EncroCrypt.MAGIC3
+                EncroCrypt.struct_header3.pack_into(workspace, len(EncroCrypt.MAGIC3), packet_type, payload_length, self.sequence, int(time.time() / 60))
+                fields = workspace[len(EncroCrypt.MAGIC3) : pos - 4]
+                EncroCrypt.struct_int.pack_into(workspace, pos - 4, zlib.crc32(fields))
+                cipher.update(fields)  # the MAC covers the header too, so the timestamp and sequence number are authenticated
+                self.sequence += 1
+
+            workspace[pos : pos + EncroCrypt.LENGTH_COUNTER_NONCE] = nonce
+            pos += EncroCrypt.LENGTH_COUNTER_NONCE
+            cipher.encrypt(plaintext, output=workspace[pos : pos + len(plaintext)])
+            pos += len(plaintext)
+            workspace[pos : pos + EncroCrypt.LENGTH_MAC] = cipher.digest()
+            pos += EncroCrypt.LENGTH_MAC
+
+            written += out.write(workspace[ : pos])
+
+        return written
+
+
+    def _unwrap_key(self, packet_data):
+        decrypted = self.gpg.decrypt(packet_data)
+        if not decrypted.ok:
+            raise Exception('Failed to decrypt PGP data')
+
+        if decrypted.fingerprint != self.signing_fingerprint:
+            raise Exception('Signature not from a trusted key: signed with fingerprint "{}", should be "{}"'.format(decrypted.fingerprint, self.signing_fingerprint))
+
+        return decrypted.data
+
+
+    def _load_key(self, packet_data):
+        if self.key_cache is None:
+            self.key = self._unwrap_key(packet_data)
+        else:
+            cache_key = KeyCache.cache_key(self.signing_fingerprint, packet_data)
+            key = self.key_cache.get(cache_key)
+            if key is None:
+                key = self._unwrap_key(packet_data)
+                self.key_cache.put(cache_key, key)
+            self.key = key
 
-            data = data[EncroCrypt.PACKET_MAXLENGTH : ]
+        self.expected_nonce = None
 
-        return output
 
+    def prefetch_keys(self, encrypted_stream, key_offsets, jobs=4):
+        """
+        encrocrypt_obj.prefetch_keys(seekable file object, list of ints, int)
+        Unwraps the key packets at the given offsets (e.g. from an EncroIndex) into the key cache up front, running up to
+        `jobs` GnuPG processes at a time, so that decrypt() finds them all in the cache. Creates a memory-only key cache if
+        this object has none. Keys that fail to unwrap are left for decrypt() to report. The stream position is restored.
+        """
+        if self.key_cache is None:
+            self.key_cache = KeyCache()
+
+        position = encrypted_stream.tell()
+        packets = []
+        for key_offset in key_offsets:
+            encrypted_stream.seek(key_offset)
+            header = EncroCrypt.parse_header(encrypted_stream.read(EncroCrypt.READ_HEADER))
+            if header is None or header[0] != EncroCrypt.PACKET_NEWKEY:
+                continue
+            encrypted_stream.seek(key_offset + header[3])
+            packet_data = encrypted_stream.read(header[1])
+            if self.key_cache.get(KeyCache.cache_key(self.signing_fingerprint, packet_data)) is None:
+                packets.append(packet_data)
+        encrypted_stream.seek(position)
 
-    def _seek_to_magic(self):
-        buf = b''
-        while True:
-            tmp = self.streamed_read(1)
-            if len(tmp) == 0:
-                return False
+        # Each gpg.decrypt() call is its own GnuPG process, so threads are enough to have several running at once
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(self._unwrap_key, packet_data): packet_data for packet_data in packets}
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is None:
+                    self.key_cache.put(KeyCache.cache_key(self.signing_fingerprint, futures[future]), future.result())
 
-            buf += tmp
+        return len(packets)
+
+
+    def seek(self, encrypted_stream, key_offset, video_offset):
+        """
+        encrocrypt_obj.seek(seekable file object, int, int)
+        Loads the key from the key packet at key_offset and positions the stream at video_offset, such that a subsequent
+        decrypt() call starts there. The offsets would normally come from an EncroIndex.
+        """
+        encrypted_stream.seek(key_offset)
+        header = EncroCrypt.parse_header(encrypted_stream.read(EncroCrypt.READ_HEADER))
+        if header is None or header[0] != EncroCrypt.PACKET_NEWKEY:
+            raise Exception(f'No key packet at byte offset {key_offset}')
+
+        packet_type, packet_length, minute, header_length = header
+        encrypted_stream.seek(key_offset + header_length)
+        self._load_key(encrypted_stream.read(packet_length))
+        self.expected_sequence = None  # the packets in between are skipped on purpose
+        encrypted_stream.seek(video_offset)
+
+
+    def decrypt_packet(self, encrypted_stream, offset):
+        """
+        encrocrypt_obj.decrypt_packet(seekable file object, int) -> (bytes, int, bytes or None)
+        Reads and decrypts only the video data or metadata packet at the given offset (e.g. from an EncroIndex), with the
+        key of the last key packet that seek() or decrypt() loaded. Returns the packet type, the timestamp, and the
+        plaintext, or None instead of the plaintext if the MAC does not match.
+        """
+        encrypted_stream.seek(offset)
+        header = encrypted_stream.read(EncroCrypt.READ_HEADER)
+        parsed = EncroCrypt.parse_header(header)
+        if parsed is None or parsed[0] not in [EncroCrypt.PACKET_VIDEODATA, EncroCrypt.PACKET_VIDEODATA_COUNTER, EncroCrypt.PACKET_METADATA]:
+            raise Exception(f'No data packet at byte offset {offset}')
+        if self.key is None:
+            raise Exception('No key loaded')
+
+        packet_type, packet_length, minute, header_length = parsed
+        encrypted_stream.seek(offset + header_length)
+        packet_data = encrypted_stream.read(packet_length)
+        if len(packet_data) != packet_length:
+            raise Exception(f'Packet at byte offset {offset} is cut off')
+
+        # Same layout as in _decrypt_packets(): in the version 3 framing, the header is authenticated along with the data
+        fields = header[len(EncroCrypt.MAGIC3) : EncroCrypt.LENGTH_HEADER3 - 4] if header_length == EncroCrypt.LENGTH_HEADER3 else None
+        payload_start = 0 if fields is not None else 4
+        nonce_length = EncroCrypt.LENGTH_NONCE if packet_type == EncroCrypt.PACKET_VIDEODATA else EncroCrypt.LENGTH_COUNTER_NONCE
+        nonce = packet_data[payload_start : payload_start + nonce_length]
+        ciphertext = packet_data[payload_start + nonce_length : -EncroCrypt.LENGTH_MAC]
+        mac = packet_data[-EncroCrypt.LENGTH_MAC : ]
+        return packet_type, minute * 60, EncroCrypt._open_video(self.key, nonce, ciphertext, mac, fields)
+
+
+    def _check_counter(self, nonce, offset):
+        prefix = nonce[ : EncroCrypt.LENGTH_NONCE_PREFIX]
+        counter = EncroCrypt.struct_int.unpack(nonce[EncroCrypt.LENGTH_NONCE_PREFIX : ])[0]
+        if self.expected_nonce is not None and self.expected_nonce[0] == prefix and self.expected_nonce[1] != counter:
+            if counter > self.expected_nonce[1]:
+                self._problem('missing packets', offset, f'{counter - self.expected_nonce[1]} video data packet(s) missing before byte offset {offset}', counter - self.expected_nonce[1])
+            else:
+                self._problem('out of order', offset, f'Video data packet at byte offset {offset} is out of order (counter {counter}, expected {self.expected_nonce[1]})')
+        self.expected_nonce = (prefix, counter + 1)
+
+
+    def _check_sequence(self, sequence, offset):
+        # Like _check_counter(), for the sequence numbers of the version 3 framing, which also count key packets. A
+        # sequence number of 0 is a new EncroCrypt object, e.g. record.py restarted and appends to the same file.
+        if self.expected_sequence is not None and sequence != 0 and sequence != self.expected_sequence:
+            if sequence > self.expected_sequence:
+                self._problem('missing packets', offset, f'{sequence - self.expected_sequence} packet(s) missing before byte offset {offset}', sequence - self.expected_sequence)
+            else:
+                self._problem('out of order', offset, f'Packet at byte offset {offset} is out of order (sequence number {sequence}, expected {self.expected_sequence})')
+        self.expected_sequence = sequence + 1
 
-            if buf[-len(EncroCrypt.MAGIC) : ] == EncroCrypt.MAGIC:
-                warn(f'Found a magic token at {self.streamreader_source.tell()}')
-                return True
 
-            if len(buf) > len(EncroCrypt.MAGIC) * 50:
-                buf = buf[-len(EncroCrypt.MAGIC) : ]
+    def _seek_to_magic(self):
+        # Search the buffer for a magic string of either version, refilling it chunk by chunk. Finding the magic consumes
+        # it. Returns the magic string that was found, or None at EOF.
+        while True:
+            pos = self.streamreader_buffer.find(EncroCrypt.MAGIC_PREFIX, self.streamreader_start)
+            if pos != -1:
+                self._stream_skip(pos - self.streamreader_start)
+                magic = self.streamed_read(len(EncroCrypt.MAGIC))
+                if magic == EncroCrypt.MAGIC or magic == EncroCrypt.MAGIC3:
+                    self._problem('resync', self.streamreader_position, f'Found a magic token at {self.streamreader_position}')
+                    return magic
+                if len(magic) < len(EncroCrypt.MAGIC):
+                    return None  # EOF
+                self.streamed_unread(magic[1 : ])  # an unknown version, or no version at all: keep looking after it
+                continue
+
+            # Not in there: drop everything except a tail that could be the start of a magic cut off by the chunk boundary
+            available = len(self.streamreader_buffer) - self.streamreader_start
+            self._stream_skip(max(0, available - (len(EncroCrypt.MAGIC_PREFIX) - 1)))
+            available = len(self.streamreader_buffer) - self.streamreader_start
+            if self._stream_fill(available + EncroCrypt.STREAM_CHUNK) <= available:
+                self._stream_skip(available)  # EOF
+                return None
 
 
     def stream_reader(self, stream):
-        # This allows us to prepend data if we read too far. Avoids depending on seekable input; this way you can use stdin.
+        # Reads ahead in large chunks into one reusable buffer, which also allows us to put data back if we read too far.
+        # Avoids depending on seekable input; this way you can use stdin.
         self.streamreader_source = stream
-        self.streamreader_buffer = b''
+        # read1() returns whatever a pipe has available instead of waiting until it has a whole chunk for us
+        self.streamreader_read = getattr(stream, 'read1', stream.read)
+        self.streamreader_buffer = bytearray()
+        self.streamreader_start = 0  # index in the buffer of the next byte that streamed_read will return
+        # Our own idea of the offset in the stream (of the next byte streamed_read will return), because pipes can't tell()
+        try:
+            self.streamreader_position = stream.tell()
+        except OSError:
+            self.streamreader_position = 0
+
+
+    def _stream_fill(self, length):
+        # Reads until `length` bytes are buffered or the stream has no more data. Returns how many bytes are available.
+        while len(self.streamreader_buffer) - self.streamreader_start < length:
+            if self.streamreader_start > 0:
+                # Move the unread data to the front rather than letting the buffer grow
+                del self.streamreader_buffer[ : self.streamreader_start]
+                self.streamreader_start = 0
+            tmp = self.streamreader_read(max(length - len(self.streamreader_buffer), EncroCrypt.STREAM_CHUNK))
+            if not tmp:  # EOF (or None: no data right now from a non-blocking stream)
+                break
+            self.streamreader_buffer += tmp
+
+        return min(length, len(self.streamreader_buffer) - self.streamreader_start)
+
+
+    def _stream_skip(self, length):
+        self.streamreader_start += length
+        self.streamreader_position += length
 
 
     def streamed_read(self, length):
         # Read from the data stream created using self.stream_reader(fd)
-        if len(self.streamreader_buffer) < length:
-            val = self.streamreader_buffer + self.streamreader_source.read(length - len(self.streamreader_buffer))
-            self.streamreader_buffer = b''
-        else:
-            val = self.streamreader_buffer[0 : length]
-            self.streamreader_buffer = self.streamreader_buffer[length : ]
-
+        length = self._stream_fill(length)
+        with memoryview(self.streamreader_buffer) as view:
+            val = bytes(view[self.streamreader_start : self.streamreader_start + length])
+        self._stream_skip(length)
         return val
 
 
-    def decrypt(self, encrypted_stream, decrypted_stream, skip_until=None):
+    def streamed_unread(self, data):
+        # Put data back in front of the stream, for when we read too far
+        if self.streamreader_buffer[max(0, self.streamreader_start - len(data)) : self.streamreader_start] == data:
+            # Usually it is the tail of what we just read, which is still in the buffer
+            self.streamreader_start -= len(data)
+        else:
+            self.streamreader_buffer[self.streamreader_start : self.streamreader_start] = data
+        self.streamreader_position -= len(data)
+
+
+    @staticmethod
+    def _open_video(key, nonce, ciphertext, mac, header=None):
+        # Returns the plaintext, or None if the MAC does not match. Runs in worker threads when decrypting with jobs > 1,
+        # which works in parallel because pycryptodome releases the GIL while it is in its C code
+        try:
+            cipher = AES.new(mode=AES.MODE_GCM, key=key, nonce=nonce)
+            if header is not None:
+                cipher.update(header)
+            return cipher.decrypt_and_verify(ciphertext, mac)
+        except ValueError:
+            return None
+
+
+    def _finish_video(self, job, decrypted):
+        # Everything that has to happen in order after a video data packet was decrypted
+        packet_type, nonce, timestamp, offset, sequence = job
+        if decrypted is None:
+            self._problem('MAC failure', offset, f'MAC validation failed at byte offset {offset}. Bit rot, or has the file been tampered with?')
+            return
+
+        self.packets_verified += 1
+        if packet_type != EncroCrypt.PACKET_METADATA:
+            self.verified_minutes.add(timestamp // 60)
+        if nonce[-1] < 8 and self.verbose:  # update once every 8/256 decrypts on average
+            statusinfo(f'Decrypted video data with verified signature until {timefmt(timestamp)}...')
+
+        if sequence is not None:
+            # The header is authenticated now, so the sequence number tells us for free whether packets went missing
+            self._check_sequence(sequence, offset)
+        elif packet_type != EncroCrypt.PACKET_VIDEODATA:
+            # The nonce is authenticated now, so the counter tells us for free whether packets went missing
+            self._check_counter(nonce, offset)
+
+        if packet_type != EncroCrypt.PACKET_METADATA:  # metadata is not part of the video; see EncroIndex.metadata and decrypter.py --search
+            self.decrypted_stream.write(decrypted)
+
+
+    def _flush_pending(self, keep):
+        # Write out decrypted packets from the worker threads, oldest first, until at most `keep` are still pending
+        while len(self.pending) > keep:
+            job, future = self.pending.popleft()
+            self._finish_video(job, future.result())
+
+
+    def _problem(self, kind, offset, message, count=1):
+        # Counts a problem with the input (see decrypt()) and tells the user about it
+        if kind not in self.problems:
+            self.first_problem_offset[kind] = offset
+        self.problems[kind] += count
+        if self.verbose and message is not None:
+            warn(message)
+
+
+    def flush_output(self):
+        """
+        encrocrypt_obj.flush_output()
+        While decrypt() is running (e.g. from a FollowReader's on_wait): writes out all packets that were decrypted so far,
+        including those still with the worker threads, and flushes the output stream.
+        """
+        self._flush_pending(0)
+        self.decrypted_stream.flush()
+
+
+    def decrypt(self, encrypted_stream, decrypted_stream, skip_until=None, jobs=1, stop_at=None):
         """
-        encrocrypt_obj.decrypt(file object, file object, int or None)
+        encrocrypt_obj.decrypt(file object, file object, int or None, int, int or None)
         Reads EncroCrypt-formatted bytes from the first argument and writes the plaintext to the second argument,
         seeking in the input until finding the right integer in a video data packet if skip_until is not None.
-        Will write to stderr for non-fatal issues.
+        If stop_at is not None, returns (True) at the first video data packet timestamped at or after it, instead of
+        reading until the end of the input.
+        With jobs > 1, video data packets are verified and decrypted on that many threads while the input is being
+        parsed; the output is still written in order, and at most jobs * 4 packets are held in memory.
+        Will write to stderr for non-fatal issues. They are also counted per kind in self.problems (a Counter; its keys
+        are e.g. 'MAC failure', 'resync', 'cut off'), with the byte offset of the first one in self.first_problem_offset.
+        self.verified_minutes is the set of minutes (unix timestamp // 60) of the video data that was verified.
+        Metadata packets are verified as well, but not written to the output.
         """
+        self.problems = collections.Counter()
+        self.first_problem_offset = {}
+        self.packets_verified = 0
+        self.verified_minutes = set()
+        self.previous_packet = None  # (data, offset) of the last version 3 packet, in case it turns out to be cut off
         self.stream_reader(encrypted_stream)
+        self.decrypted_stream = decrypted_stream
+        self.pending = collections.deque()  # (job, future) of packets being decrypted by the executor, in input order
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
 
+        try:
+            return self._decrypt_packets(skip_until, stop_at, jobs * 4)
+        finally:
+            self._flush_pending(0)
+            if self.executor is not None:
+                self.executor.shutdown()
+
+
+    def _decrypt_packets(self, skip_until, stop_at, max_pending):
         while True:
             val = self.streamed_read(len(EncroCrypt.MAGIC))
             if len(val) == 0:  # EOF
                 return True
 
-            if val != EncroCrypt.MAGIC:
-                wasat = encrypted_stream.tell()
-                if not self._seek_to_magic():
-                    raise Exception(f'File cut off, no valid data found since around {wasat} bytes (reason: missing magic)')
+            if val != EncroCrypt.MAGIC3 and val != EncroCrypt.MAGIC:
+                if self.previous_packet is not None and EncroCrypt.MAGIC_PREFIX in self.previous_packet[0]:
+                    # The packet before did not end where the next one starts, and there is a magic in it: it was cut off
+                    # (e.g. the recorder was killed while writing it and then appended to the file), and its length
+                    # made us read into the next packet. That packet itself is lost (it failed its MAC, or was not a
+                    # valid key packet), but we can go back to the magic and continue from there.
+                    # (Same as below: you might be able to recover something here if you keep in mind it's unauthenticated.)
+                    packet_data, offset = self.previous_packet
+                    self.previous_packet = None
+                    self._problem('resync', offset, f'Packet at byte offset {offset} is cut off by the next one')
+                    self.streamed_unread(packet_data[packet_data.index(EncroCrypt.MAGIC_PREFIX) : ] + val)
+                    continue
 
-            packet_type = self.streamed_read(1)
-            if len(packet_type) == 0:
-                warn(f'File cut off at byte offset {encrypted_stream.tell()} (reason: missing packet type)')
-                return False
+                wasat = self.streamreader_position
+                val = self._seek_to_magic()
+                if val is None:
+                    self._problem('cut off', wasat, None)  # the exception tells the user
+                    raise Exception(f'File cut off, no valid data found since around {wasat} bytes (reason: missing magic)')
+            self.previous_packet = None
 
             try:
-                packet_length = EncroCrypt.struct_int.unpack(self.streamed_read(4))[0]
-                if packet_length > EncroCrypt.PACKET_MAXLENGTH:
-                    # We stumbled upon some random data... seek the next magic token
-                    warn(f'Indicated packet length impossibly long at byte offset {encrypted_stream.tell()}, skipping to the next magic token')
-                    continue
+                if val == EncroCrypt.MAGIC3:
+                    header = self.streamed_read(EncroCrypt.LENGTH_HEADER3 - len(EncroCrypt.MAGIC3))
+                    if len(header) != EncroCrypt.LENGTH_HEADER3 - len(EncroCrypt.MAGIC3):
+                        self._problem('cut off', self.streamreader_position, f'File cut off at byte offset {self.streamreader_position} (reason: incomplete header)')
+                        return False
+
+                    fields = header[ : -4]
+                    if zlib.crc32(fields) != EncroCrypt.struct_int.unpack_from(header, len(fields))[0]:
+                        # Corrupted, or a magic string that happens to be in some random data: the fields can't be trusted
+                        self._problem('invalid header', self.streamreader_position, f'Packet header checksum mismatch at byte offset {self.streamreader_position}, skipping to the next magic token')
+                        self.streamed_unread(header)
+                        continue
 
-                if packet_length == 0:
-                    warn(f'Zero-length data of type {packet_type} at offset {encrypted_stream.tell()} in encrypted stream')
-                    continue
+                    packet_type, packet_length, sequence, minute = EncroCrypt.struct_header3.unpack(fields)
+                    if packet_length > EncroCrypt.PACKET_MAXLENGTH:
+                        self._problem('invalid header', self.streamreader_position, f'Indicated packet length impossibly long at byte offset {self.streamreader_position}, skipping to the next magic token')
+                        continue
 
-                packet_data = self.streamed_read(packet_length)
-
-                if len(packet_data) != packet_length:
-                    # If you keep in mind that it's unauthenticated, you could try if part of this packet is decryptable and squeeze
-                    # a few more frames out of the encrypted video file (i.e. don't return false and skip some validation below).
-                    # Not supported by default to avoid giving a false sense of reliability (an attacker could use this). If something
-                    # important happened, someone knowledgeable can look into the source and make their own educated decisions rather
-                    # than getting unauth'd data without realizing.
-                    warn(f'File cut off at byte offset {encrypted_stream.tell()} (reason: incomplete read)')
-                    return False
-
-                if EncroCrypt.MAGIC in packet_data:
-                    # partial packet... rewind to magic and retry
-                    # (Same as above: you might be able to recover something here if you keep in mind it's unauthenticated.)
-                    self.streamreader_buffer = packet_data[packet_data.index(EncroCrypt.MAGIC) : ] + self.streamreader_buffer
-                    continue
+                    # With a valid header, the length is right unless the packet was cut off. Rather than searching all
+                    # the data for a magic string to find out, we check that the next packet starts where this one ends
+                    # when reading it (see above).
+                    packet_data = self.streamed_read(packet_length)
+                    if len(packet_data) != packet_length:
+                        self._problem('cut off', self.streamreader_position, f'File cut off at byte offset {self.streamreader_position} (reason: incomplete read)')
+                        return False
+                    self.previous_packet = (packet_data, self.streamreader_position - packet_length)
+                    payload_start = 0
 
-                if packet_type == EncroCrypt.PACKET_NEWKEY:
-                    decrypted = self.gpg.decrypt(packet_data)
-                    if not decrypted.ok:
-                        raise Exception('Failed to decrypt PGP data')
+                else:
+                    packet_type = self.streamed_read(1)
+                    if len(packet_type) == 0:
+                        self._problem('cut off', self.streamreader_position, f'File cut off at byte offset {self.streamreader_position} (reason: missing packet type)')
+                        return False
+
+                    packet_length = EncroCrypt.struct_int.unpack(self.streamed_read(4))[0]
+                    if packet_length > EncroCrypt.PACKET_MAXLENGTH:
+                        # We stumbled upon some random data... seek the next magic token
+                        self._problem('invalid header', self.streamreader_position, f'Indicated packet length impossibly long at byte offset {self.streamreader_position}, skipping to the next magic token')
+                        continue
+
+                    if packet_length == 0:
+                        self._problem('invalid header', self.streamreader_position, f'Zero-length data of type {packet_type} at offset {self.streamreader_position} in encrypted stream')
+                        continue
 
-                    if decrypted.fingerprint != self.signing_fingerprint:
-                        raise Exception('Signature not from a trusted key: signed with fingerprint "{}", should be "{}"'.format(decrypted.fingerprint, self.signing_fingerprint))
+                    packet_data = self.streamed_read(packet_length)
+
+                    if len(packet_data) != packet_length:
+                        # If you keep in mind that it's unauthenticated, you could try if part of this packet is decryptable and squeeze
+                        # a few more frames out of the encrypted video file (i.e. don't return false and skip some validation below).
+                        # Not supported by default to avoid giving a false sense of reliability (an attacker could use this). If something
+                        # important happened, someone knowledgeable can look into the source and make their own educated decisions rather
+                        # than getting unauth'd data without realizing.
+                        self._problem('cut off', self.streamreader_position, f'File cut off at byte offset {self.streamreader_position} (reason: incomplete read)')
+                        return False
+
+                    if EncroCrypt.MAGIC_PREFIX in packet_data:
+                        # partial packet... rewind to magic and retry
+                        # (Same as above: you might be able to recover something here if you keep in mind it's unauthenticated.)
+                        self._problem('resync', self.streamreader_position - packet_length, f'Packet at byte offset {self.streamreader_position - packet_length} is cut off by the next one')
+                        self.streamed_unread(packet_data[packet_data.index(EncroCrypt.MAGIC_PREFIX) : ])
+                        continue
+
+                    payload_start = 4  # the timestamp comes first
+                    sequence = fields = None
+
+                if packet_type == EncroCrypt.PACKET_NEWKEY:
+                    self._load_key(packet_data)
+                    if sequence is not None:
+                        self._flush_pending(0)  # the video data packets before it have to be checked first
+                        self._check_sequence(sequence, self.streamreader_position)
+
+                elif packet_type in [EncroCrypt.PACKET_VIDEODATA, EncroCrypt.PACKET_VIDEODATA_COUNTER, EncroCrypt.PACKET_METADATA]:
+                    if fields is not None:
+                        timestamp = minute * 60
                     else:
-                        self.key = decrypted.data
+                        timestamp = EncroCrypt.struct_int.unpack(packet_data[ : 4])[0] * 60
 
-                elif packet_type == EncroCrypt.PACKET_VIDEODATA:
-                    timestamp = EncroCrypt.struct_int.unpack(packet_data[ : 4])[0] * 60
+                    if stop_at is not None and timestamp >= stop_at:
+                        return True
 
                     if self.key is None:
                         if not self.showed_data_before_key_warning:
-                            warn(f'Found a video data packet (timestamped {timefmt(timestamp)}) before having seen an encryption key packet: cannot decrypt this.')
+                            self._problem('no key', self.streamreader_position, f'Found a video data packet (timestamped {timefmt(timestamp)}) before having seen an encryption key packet: cannot decrypt this.')
                             self.showed_data_before_key_warning = True
                         continue
                     else:
-                        if self.showed_data_before_key_warning:
+                        if self.showed_data_before_key_warning and self.verbose:
                             warn(f'Found a video data packet (timestamped {timefmt(timestamp)}) for which we do have the key.')
                         self.showed_data_before_key_warning = False
 
                     if skip_until is not None and timestamp < skip_until:
-                        statusinfo(f'Seeking... ({timestamp}/{skip_until})')
+                        if self.verbose:
+                            statusinfo(f'Seeking... ({timestamp}/{skip_until})')
+                        self.expected_nonce = None
+                        self.expected_sequence = None
                         continue
 
-                    nonce = packet_data[4 : 4 + EncroCrypt.LENGTH_NONCE]
-                    ciphertext = packet_data[4 + EncroCrypt.LENGTH_NONCE : -EncroCrypt.LENGTH_MAC]
+                    nonce_length = EncroCrypt.LENGTH_NONCE if packet_type == EncroCrypt.PACKET_VIDEODATA else EncroCrypt.LENGTH_COUNTER_NONCE
+                    nonce = packet_data[payload_start : payload_start + nonce_length]
+                    ciphertext = memoryview(packet_data)[payload_start + nonce_length : -EncroCrypt.LENGTH_MAC]
                     mac = packet_data[-EncroCrypt.LENGTH_MAC : ]
 
-                    cipher = AES.new(mode=AES.MODE_GCM, key=self.key, nonce=nonce)
-
-                    try:
-                        decrypted = cipher.decrypt_and_verify(ciphertext, mac)
-                        if nonce[-1] < 8:  # update once every 8/256 decrypts on average
-                            statusinfo(f'Decrypted video data with verified signature until {timefmt(timestamp)}...')
-                    except ValueError:
-                        warn(f'MAC validation failed at byte offset {encrypted_stream.tell()}. Bit rot, or has the file been tampered with?')
-                        continue
-
-                    decrypted_stream.write(decrypted)
+                    job = (packet_type, nonce, timestamp, self.streamreader_position, sequence)
+                    if self.executor is None:
+                        self._finish_video(job, EncroCrypt._open_video(self.key, nonce, ciphertext, mac, fields))
+                    else:
+                        self.pending.append((job, self.executor.submit(EncroCrypt._open_video, self.key, nonce, ciphertext, mac, fields)))
+                        self._flush_pending(max_pending)
 
                 else:
                     raise Exception('Invalid packet type: data corrupted or made with a newer version')
 
             except Exception as e:
-                warn(f'{type(e).__name__} in {e.__traceback__.tb_frame.f_code.co_filename}:{e.__traceback__.tb_lineno} | offset in encrypted stream: {encrypted_stream.tell()} | error message: {e}')
+                self._problem('error', self.streamreader_position, f'{type(e).__name__} in {e.__traceback__.tb_frame.f_code.co_filename}:{e.__traceback__.tb_lineno} | offset in encrypted stream: {self.streamreader_position} | error message: {e}')
                 # TODO check if this is useful
                 """
                 if 'Signature not from a trusted key' in str(e):
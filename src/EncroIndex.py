@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import os, struct, bisect  # stdlib imports
+from EncroCrypt import EncroCrypt, warn
+
+
+class EncroIndex:
+    """
+    Sparse index of an .encrocam file that maps minute timestamps to byte offsets, so that seeking does not need to read
+    the whole recording. Per indexed minute, it stores the offset of the first video data packet with that timestamp and
+    of the key packet that precedes it. Building the index reads only the packet headers and timestamps, not the data.
+    It also lists every metadata packet (see EncroCrypt.encrypt_metadata()), so those can be read without going through
+    the video.
+    The index is cached in a sidecar file next to the recording (<recording>.index).
+    """
+
+    MAGIC = b'EncroIndex2\n'
+
+    NO_KEY = 2**64 - 1  # key offset placeholder while no key packet was seen yet
+
+    struct_state = struct.Struct(">QQQ")  # indexed_until, offset of the most recent key packet, number of entries (the metadata entries come after them)
+    struct_entry = struct.Struct(">IQQ")  # minute, key packet offset, video (or metadata) packet offset
+
+    SCAN_CHUNK = 1024 * 1024
+
+    def __init__(self, recording_path):
+        self.recording_path = recording_path
+        self.index_path = recording_path + '.index'
+        self._clear()
+
+
+    def _clear(self):
+        self.entries = []  # (minute, key offset, video packet offset) with increasing minutes
+        self.metadata = []  # (minute, key offset, metadata packet offset) of every metadata packet, in file order
+        self.indexed_until = 0  # the end of the last complete packet that was indexed
+        self.last_key_offset = EncroIndex.NO_KEY
+
+
+    def load(self):
+        """
+        index_obj.load() -> index_obj
+        Reads the sidecar file if there is one, rebuilds it if it does not match the recording, and indexes any data that
+        was appended to the recording since. Writes the result back to the sidecar file if possible.
+        """
+        if not self._read():
+            self._clear()
+
+        if os.path.getsize(self.recording_path) > self.indexed_until:
+            self.update()
+            self._write()
+
+        return self
+
+
+    def rebuild(self):
+        """
+        index_obj.rebuild() -> index_obj
+        Indexes the recording from the start, discarding any existing sidecar file contents.
+        """
+        self._clear()
+        self.update()
+        self._write()
+        return self
+
+
+    def _read(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+
+        if not data.startswith(EncroIndex.MAGIC) or (len(data) - len(EncroIndex.MAGIC) - EncroIndex.struct_state.size) % EncroIndex.struct_entry.size != 0:
+            warn(f'Ignoring unrecognized index file {self.index_path}')
+            return False
+
+        pos = len(EncroIndex.MAGIC)
+        self.indexed_until, self.last_key_offset, count = EncroIndex.struct_state.unpack_from(data, pos)
+        pos += EncroIndex.struct_state.size
+        entries = [entry for entry in EncroIndex.struct_entry.iter_unpack(data[pos : ])]
+        self.entries = entries[ : count]
+        self.metadata = entries[count : ]
+
+        if os.path.getsize(self.recording_path) < self.indexed_until:
+            warn('Recording is shorter than its index says, rebuilding the index')
+            return False
+
+        # Spot-check that the index belongs to this file: the packets it points to should be where it says they are
+        with open(self.recording_path, 'rb') as recording:
+            for entry in self.entries[ : 1] + self.entries[-1 : ]:
+                if not self.valid(recording, entry):
+                    warn('Index does not match the recording, rebuilding the index')
+                    return False
+
+        return True
+
+
+    def _write(self):
+        tmppath = self.index_path + '.tmp'
+        try:
+            with open(tmppath, 'wb') as f:
+                f.write(EncroIndex.MAGIC)
+                f.write(EncroIndex.struct_state.pack(self.indexed_until, self.last_key_offset, len(self.entries)))
+                for entry in self.entries + self.metadata:
+                    f.write(EncroIndex.struct_entry.pack(*entry))
+            os.replace(tmppath, self.index_path)
+        except OSError as e:
+            # Not fatal, e.g. a read-only directory: the index just won't be cached for next time
+            warn(f'Could not write index file {self.index_path}: {e}')
+
+
+    def update(self):
+        """
+        index_obj.update()
+        Indexes the recording from where the index ended until the last complete packet.
+        """
+        with open(self.recording_path, 'rb') as recording:
+            size = os.fstat(recording.fileno()).st_size
+            offset = self.indexed_until
+            resync_from = offset + 1  # where to look for a magic string if there is no valid header at offset
+            while True:
+                recording.seek(offset)
+                header = recording.read(EncroCrypt.READ_HEADER)
+                if len(header) < EncroCrypt.LENGTH_HEADER or (header.startswith(EncroCrypt.MAGIC3) and len(header) < EncroCrypt.LENGTH_HEADER3):
+                    break  # (the start of) a header that is still being written
+
+                parsed = EncroCrypt.parse_header(header)
+                if parsed is None:
+                    # Corrupted, or the packet before was cut off and its length pointed past where the next one starts,
+                    # in which case the next one starts inside of it: look from right after the previous magic
+                    offset = self._find_magic(recording, resync_from)
+                    if offset is None:
+                        break
+                    resync_from = offset + 1
+                    continue
+
+                packet_type, packet_length, minute, header_length = parsed
+                end = offset + header_length + packet_length
+                if end > size:
+                    break  # incomplete packet (still being written): index it next time
+
+                if packet_type == EncroCrypt.PACKET_NEWKEY:
+                    self.last_key_offset = offset
+                elif packet_type in [EncroCrypt.PACKET_VIDEODATA, EncroCrypt.PACKET_VIDEODATA_COUNTER] and self.last_key_offset != EncroIndex.NO_KEY:
+                    if len(self.entries) == 0 or minute > self.entries[-1][0]:
+                        self.entries.append((minute, self.last_key_offset, offset))
+                elif packet_type == EncroCrypt.PACKET_METADATA and self.last_key_offset != EncroIndex.NO_KEY:
+                    self.metadata.append((minute, self.last_key_offset, offset))
+
+                resync_from = offset + 1
+                offset = end
+                self.indexed_until = end
+
+
+    def _find_magic(self, recording, offset):
+        # Corrupted data: look for the next packet in chunks, overlapping so a magic string across the boundary is found
+        recording.seek(offset)
+        while True:
+            chunk = recording.read(EncroIndex.SCAN_CHUNK)
+            if len(chunk) < len(EncroCrypt.MAGIC_PREFIX):
+                return None
+            pos = chunk.find(EncroCrypt.MAGIC_PREFIX)  # of either version; the header after it is checked by the caller
+            if pos != -1:
+                return offset + pos
+            offset += len(chunk) - len(EncroCrypt.MAGIC_PREFIX) + 1
+            recording.seek(offset)
+
+
+    def valid(self, recording, entry):
+        # Whether the entry still points at a key packet and a video packet with the indexed minute
+        minute, key_offset, video_offset = entry
+        recording.seek(key_offset)
+        header = EncroCrypt.parse_header(recording.read(EncroCrypt.READ_HEADER))
+        if header is None or header[0] != EncroCrypt.PACKET_NEWKEY:
+            return False
+        recording.seek(video_offset)
+        header = EncroCrypt.parse_header(recording.read(EncroCrypt.READ_HEADER))
+        if header is None or header[0] not in [EncroCrypt.PACKET_VIDEODATA, EncroCrypt.PACKET_VIDEODATA_COUNTER]:
+            return False
+        return header[2] == minute
+
+
+    def lookup(self, timestamp):
+        """
+        index_obj.lookup(int) -> (minute, key offset, video packet offset) or None
+        Finds where to start decrypting to get the video data from the given unix timestamp onward: the last indexed
+        minute at or before the timestamp. Returns None if the timestamp is before the first indexed minute.
+        """
+        # Entries compare by minute first, and the infinity sorts after any offsets, so this finds the position after
+        # the entries up to and including the timestamp's minute (bisect's key argument would need Python 3.10)
+        i = bisect.bisect_right(self.entries, (int(timestamp // 60), float('inf')))
+        if i == 0:
+            return None
+        return self.entries[i - 1]
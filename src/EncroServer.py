@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import os, io, re, time, datetime, threading, collections, http.server, urllib.parse  # stdlib imports
+from EncroCrypt import EncroCrypt, warn
+from EncroIndex import EncroIndex
+import hls
+
+
+class MinuteCache:
+    """
+    Least-recently-used cache of decrypted minutes of a recording, limited to max_bytes of plaintext in total, so that
+    scrubbing back and forth does not decrypt the same data again. Minutes rather than segments, because a segment
+    also needs the start of the next minute to find where it ends (see EncroServer.segment()).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+
+    def get(self, minute):
+        data = self.entries.get(minute)
+        if data is not None:
+            self.entries.move_to_end(minute)
+        return data
+
+
+    def put(self, minute, data):
+        if minute in self.entries:
+            self.size -= len(self.entries.pop(minute))
+        self.entries[minute] = data
+        self.size += len(data)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self.size -= len(self.entries.popitem(last=False)[1])
+
+
+class EncroServer:
+    """
+    Serves a recording over HTTP as an HLS playlist of one-minute segments, decrypting a segment only when a player
+    requests it. The index (see EncroIndex) tells where each minute starts, so a segment costs decrypting about a minute
+    of video, wherever it is in the recording. Segments start and end where ffmpeg's own HLS segments do, so each one
+    starts with a keyframe, and the playlists that ffmpeg wrote in between are left out.
+    While the recording is still being written to (or uploaded), the playlist is a growing EVENT playlist that players
+    keep reloading, so you can watch along about two minutes behind.
+    """
+
+    LIVE_SECONDS = 120  # a recording that was modified this recently is treated as still growing
+    SEGMENT_SECONDS = 60  # the duration that the playlist states; ffmpeg's segments make it a few seconds more or less
+    BOUNDARY_SECONDS = 15  # how long into a minute its first ffmpeg segment boundary is surely written (keyframes are every few seconds)
+
+    def __init__(self, recording_path, signing_fingerprint, key_cache=None, cache_bytes=256 * 1024 * 1024, jobs=1):
+        self.recording_path = recording_path
+        self.ec = EncroCrypt(signing_fingerprint, key_cache=key_cache)
+        self.jobs = jobs
+        self.cache = MinuteCache(cache_bytes)
+        self.lock = threading.Lock()  # one decryption at a time: the EncroCrypt object, cache, and key cache are shared
+        self.index = EncroIndex(recording_path)
+        self.index_size = -1  # recording size when the index was last updated
+
+
+    def _indexed_minutes(self):
+        # All minutes in the recording (minute = unix timestamp // 60), and whether it is still growing
+        with self.lock:
+            size = os.path.getsize(self.recording_path)
+            if size != self.index_size:
+                self.index.load()  # picks up what was appended since
+                self.index_size = size
+            minutes = [entry[0] for entry in self.index.entries]
+        return minutes, os.path.getmtime(self.recording_path) > time.time() - EncroServer.LIVE_SECONDS
+
+
+    def minutes(self):
+        """
+        server_obj.minutes() -> ([int], bool)
+        Returns the minutes that can be served (minute = unix timestamp // 60), and whether the recording is still growing.
+        """
+        minutes, live = self._indexed_minutes()
+        minutes = list(minutes)
+        if live and len(minutes) > 0:
+            # The last minute is still being written. The one before it is only complete once the last one has its first
+            # segment boundary, which is where a segment ends.
+            minutes.pop()
+            if len(minutes) > 0 and time.time() < (minutes[-1] + 1) * 60 + EncroServer.BOUNDARY_SECONDS:
+                minutes.pop()
+        return minutes, live
+
+
+    def _decrypt_minute(self, minute, complete):
+        # Returns the plaintext of all video data packets timestamped with this minute. Call with self.lock held.
+        data = self.cache.get(minute)
+        if data is not None:
+            return data
+
+        entry = self.index.lookup(minute * 60)
+        if entry is None or entry[0] != minute:
+            return b''
+        decrypted = io.BytesIO()
+        with open(self.recording_path, 'rb') as recording:
+            self.ec.seek(recording, entry[1], entry[2])
+            self.ec.decrypt(recording, decrypted, jobs=self.jobs, stop_at=(minute + 1) * 60)
+        data = decrypted.getvalue()
+        if complete:  # don't cache the minute that is still being written
+            self.cache.put(minute, data)
+        return data
+
+
+    def segment(self, minute):
+        """
+        server_obj.segment(int) -> bytes or None
+        Returns the transport stream data of the ffmpeg segments that start in the given minute (the first one may start
+        earlier if it is the first minute after a gap), or None if the minute is not in the recording.
+        """
+        indexed, live = self._indexed_minutes()
+        if minute not in self.minutes()[0]:
+            return None
+        after_gap = minute - 1 not in indexed
+
+        with self.lock:
+            data = self._decrypt_minute(minute, True)
+            boundary = len(data)
+            if minute + 1 in indexed:
+                # The start of the next minute has where our last segment ends
+                data += self._decrypt_minute(minute + 1, not live or minute + 1 != indexed[-1])
+
+        pieces = hls.pieces(data)
+        if not any(is_playlist for is_playlist, start, end in pieces):
+            return data[ : boundary]  # not HLS (see output_format), so serve the minute as it is
+
+        # A segment starts after each playlist: the first one that starts in this minute starts our segment, the first
+        # one that starts in the next minute ends it
+        start = 0 if after_gap and data.startswith(hls.SEGMENT_START) else None
+        end = len(data)
+        for is_playlist, piece_start, piece_end in pieces:
+            if not is_playlist:
+                continue
+            if start is None and piece_start < boundary:
+                start = piece_end
+            elif piece_start >= boundary:
+                end = piece_start
+                break
+        if start is None:
+            return b''
+
+        return b''.join(data[piece_start : piece_end] for is_playlist, piece_start, piece_end in pieces
+            if not is_playlist and piece_start >= start and piece_end <= end)
+
+
+    def playlist(self, start=None, end=None):
+        """
+        server_obj.playlist(int or None, int or None) -> string
+        Returns an HLS playlist of the segments from the unix timestamp start (inclusive) until end (exclusive).
+        """
+        minutes, live = self.minutes()
+        minutes = [minute for minute in minutes if (start is None or minute >= start // 60) and (end is None or minute < end / 60)]
+
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{EncroServer.SEGMENT_SECONDS}',
+            f'#EXT-X-MEDIA-SEQUENCE:{minutes[0] if len(minutes) > 0 else 0}',
+            '#EXT-X-PLAYLIST-TYPE:' + ('EVENT' if live and end is None else 'VOD')]
+        previous = None
+        for minute in minutes:
+            if previous is not None and minute != previous + 1:
+                lines.append('#EXT-X-DISCONTINUITY')  # a gap in the recording: the timestamps in the video jump
+            lines.append('#EXT-X-PROGRAM-DATE-TIME:' + datetime.datetime.fromtimestamp(minute * 60, datetime.timezone.utc).isoformat())
+            lines.append(f'#EXTINF:{EncroServer.SEGMENT_SECONDS}.0,')
+            lines.append(f'segment/{minute}.ts')
+            previous = minute
+        if not live or end is not None:
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+
+    def serve(self, port, address='127.0.0.1'):
+        """
+        server_obj.serve(int, string)
+        Serves the playlist on http://<address>:<port>/index.m3u8 until interrupted. The playlist takes optional start
+        and end parameters in the format YYYY-MM-DDTHH:MM (local time), e.g. /index.m3u8?start=2025-01-05T20:00
+        """
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                try:
+                    if url.path in ['/', '/index.m3u8']:
+                        query = urllib.parse.parse_qs(url.query)
+                        try:
+                            start, end = [time.mktime(datetime.datetime.strptime(query[name][0], '%Y-%m-%dT%H:%M').timetuple()) if name in query else None for name in ['start', 'end']]
+                        except ValueError as e:
+                            self.send_error(400, str(e))
+                            return
+                        self.respond(server.playlist(start, end).encode(), 'application/vnd.apple.mpegurl')
+                        return
+
+                    match = re.fullmatch('/segment/([0-9]+)\\.ts', url.path)
+                    data = server.segment(int(match.group(1))) if match is not None else None
+                    if data is None:
+                        self.send_error(404)
+                        return
+                    self.respond(data, 'video/mp2t')
+                except ConnectionError:
+                    pass  # the player went away
+                except Exception as e:
+                    # E.g. GnuPG could not decrypt the key, or the recording is damaged. Answer rather than leaving the
+                    # player waiting on a dropped connection, and say why on the console as well
+                    warn(f'Serving {url.path} failed ({type(e).__name__}: {e})')
+                    self.send_error(500, explain=f'{type(e).__name__}: {e}')
+
+
+            def respond(self, body, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                self.wfile.write(body)
+
+
+            def log_message(self, format, *args):
+                pass  # the decrypter's status info is on stdout already
+
+        httpd = http.server.ThreadingHTTPServer((address, port), Handler)
+        warn(f'Serving {self.recording_path} on http://{address}:{port}/index.m3u8')
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
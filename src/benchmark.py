@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import sys, os, io, time, json, platform, fractions, tempfile, shutil, tracemalloc, contextlib, unittest.mock  # stdlib imports
+import gnupg, Cryptodome
+from Cryptodome.Cipher import AES
+from EncroCrypt import EncroCrypt, KeyPool
+from EncroIndex import EncroIndex
+import storage
+
+if '-h' in sys.argv or '--help' in sys.argv:
+    print("""
+Usage: {self} [--json <report.json>] [megabytes]
+
+Micro-benchmarks for EncroCrypt and sync.py's uploading. Runs offline: a
+throwaway GnuPG home directory with a freshly generated key is used and removed
+afterwards, the video data is random bytes (which, like H.264, does not
+compress), and uploads go to a local directory that imitates a server's latency.
+Default amount of data per benchmark: 64 MB.
+
+Measures encrypting at the batch sizes that various encrypt_interval settings
+give, decrypting (recordings in the old and the current framing), seeking to a time (with and without the index), recovering
+from corrupted data, the storage overhead per hour of recording, the cost of a
+new key, and uploading.
+
+--json <report.json>: also write the results to a file, for comparing runs
+(e.g. before and after a change) with a script.
+""".lstrip().format(self = sys.argv[0].split('/')[-1]))
+    exit(1)
+
+json_path = None
+if '--json' in sys.argv:
+    i = sys.argv.index('--json')
+    json_path = sys.argv[i + 1]
+    del sys.argv[i : i + 2]
+megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+
+BYTES_PER_HOUR = 285 * 1000 * 1000  # what the reference setup records per hour, see the README
+INTERVALS = [fractions.Fraction(1, 32), fractions.Fraction(1, 8), fractions.Fraction(1, 2), fractions.Fraction(2)]  # encrypt_interval values to try; 1/8 is the default
+
+results = []  # for the --json report
+
+
+def throwaway_gnupghome():
+    # One key that both signs and encrypts is enough for benchmarking; gen_key without protection so no pinentry pops up
+    gnupghome = tempfile.mkdtemp(prefix='encrocam-bench-')
+    gpg = gnupg.GPG(gnupghome=gnupghome)
+    key = gpg.gen_key(gpg.gen_key_input(key_type='EDDSA', key_curve='ed25519', key_usage='sign',
+        subkey_type='ECDH', subkey_curve='cv25519', subkey_usage='encrypt',
+        name_email='benchmark@encrocam.invalid', no_protection=True))
+    if not key.fingerprint:
+        raise Exception('Could not generate a throwaway GnuPG key: ' + key.stderr)
+    return gnupghome, key.fingerprint
+
+
+def chunks(chunk_size, total):
+    chunk = os.urandom(chunk_size)
+    for _ in range(total // chunk_size):
+        yield chunk
+
+
+def record(name, value, unit, text):
+    # Prints a result and keeps it for the --json report
+    results.append({'name': name, 'value': value, 'unit': unit})
+    print(f'{name:<48} {text}')
+
+
+def report(name, nbytes, seconds, allocated=None):
+    record(name, nbytes / seconds / 1e6, 'MB/s', f'{nbytes / seconds / 1e6:9.1f} MB/s')
+    if allocated is not None:
+        results[-1]['peak_allocated_bytes'] = allocated
+        print(f'{"":<48} {allocated / 1024:9.1f} KiB peak allocated')
+
+
+def batch_size(interval):
+    # How much record.py collects in encrypt_interval seconds at BYTES_PER_HOUR
+    return int(BYTES_PER_HOUR / 3600 * interval)
+
+
+def measure(func, chunk_size, total):
+    # Returns (seconds, peak bytes allocated while processing a chunk). Separate runs because tracemalloc is slow.
+    start = time.perf_counter()
+    for chunk in chunks(chunk_size, total):
+        func(chunk)
+    seconds = time.perf_counter() - start
+
+    chunk = os.urandom(chunk_size)
+    tracemalloc.start()
+    func(chunk)
+    allocated = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, allocated
+
+
+def encrypt_copying(ec, data):
+    # encrypt() as it was before encrypt_into(), as the baseline to compare with: a new cipher and ciphertext bytes
+    # object per packet, and the packets concatenated into one bytes object (in the version 2 framing it wrote)
+    output = b''
+    if ec.key is None:
+        output += ec._new_symmetric_key()
+    while len(data) > 0:
+        timestamp = EncroCrypt.struct_int.pack(int(time.time() / 60))
+        nonce = os.urandom(EncroCrypt.LENGTH_NONCE)
+        cipher = AES.new(mode=AES.MODE_GCM, key=ec.key, nonce=nonce)
+        ciphertext, mac = cipher.encrypt_and_digest(data[ : EncroCrypt.PACKET_MAXLENGTH])
+        payload = timestamp + nonce + ciphertext + mac
+        output += EncroCrypt.MAGIC + EncroCrypt.PACKET_VIDEODATA + EncroCrypt.struct_int.pack(len(payload)) + payload
+        data = data[EncroCrypt.PACKET_MAXLENGTH : ]
+    return output
+
+
+def bench_encrypt(fingerprint, gnupghome, total):
+    # The batch that record.py encrypts at once is what ffmpeg wrote in encrypt_interval seconds (~10 KB at the default
+    # 1/8), or encrypt_max_bytes when encrypting fell behind
+    batches = [(f'interval {interval} s', batch_size(interval)) for interval in INTERVALS] + [('256 KiB', 256 * 1024)]
+    for name, chunk_size in batches:
+        with open(os.devnull, 'wb') as outfile:
+            ec = EncroCrypt(fingerprint, fingerprint, gnupghome)
+            encrypt_copying(ec, b'x')  # get the key packet out of the way
+            seconds, allocated = measure(lambda chunk: outfile.write(encrypt_copying(ec, chunk)), chunk_size, total)
+            report(f'copying encrypt() (baseline), {name}', total, seconds, allocated)
+
+            ec = EncroCrypt(fingerprint, fingerprint, gnupghome)
+            ec.encrypt_into(b'x', outfile)
+            seconds, allocated = measure(lambda chunk: ec.encrypt_into(chunk, outfile), chunk_size, total)
+            report(f'encrypt_into() file, {name}', total, seconds, allocated)
+
+
+def bench_decrypt(fingerprint, gnupghome, total):
+    # Recordings in the version 2 framing (still around from before) and the current one, which has a checksummed
+    # header instead of a search for the magic string in every packet
+    for framing in sorted(set([2, EncroCrypt.FRAMING])):
+        ec = EncroCrypt(fingerprint, fingerprint, gnupghome)
+        ec.framing = framing
+        encrypted = io.BytesIO()
+        for chunk in chunks(256 * 1024, total):
+            ec.encrypt_into(chunk, encrypted)
+
+        for jobs in sorted(set([1, 4, os.cpu_count() or 1])):
+            encrypted.seek(0)
+            dc = EncroCrypt(fingerprint, gnupghome=gnupghome)
+            with open(os.devnull, 'wb') as outfile, contextlib.redirect_stdout(io.StringIO()):  # silence the progress info
+                start = time.perf_counter()
+                cpu_start = time.process_time()
+                dc.decrypt(encrypted, outfile, jobs=jobs)
+                seconds = time.perf_counter() - start
+                cpu_seconds = time.process_time() - cpu_start
+            report(f'decrypt(), framing v{framing}, {jobs} job(s)', total, seconds)
+            # With several jobs, wall time goes down but CPU time does not: this is what parsing and decrypting costs
+            record(f'decrypt() CPU time, framing v{framing}, {jobs} job(s)', cpu_seconds / total * 1e9, 's/GB', f'{cpu_seconds / total * 1e9:9.2f} CPU s/GB')
+
+
+def write_recording(fingerprint, gnupghome, path, minutes, total):
+    # A recording of `total` bytes spread over the given number of minutes, as if recorded from unix time 0 onward
+    ec = EncroCrypt(fingerprint, fingerprint, gnupghome)
+    ec.prepare_key()
+    with open(path, 'wb') as outfile, unittest.mock.patch('EncroCrypt.time') as clock:
+        for minute in range(minutes):
+            clock.time.return_value = minute * 60
+            for chunk in chunks(batch_size(fractions.Fraction(1, 8)), total // minutes):
+                ec.encrypt_into(chunk, outfile)
+
+
+def bench_seek(fingerprint, gnupghome, total):
+    # Getting to the last minute of an hour-long recording: reading every packet header up to there (decrypt() with
+    # skip_until, what happens for pipes), building the index, and seeking with the index (what decrypter.py does)
+    minutes = 60
+    tmpdir = tempfile.mkdtemp(prefix='encrocam-bench-')
+    try:
+        path = f'{tmpdir}/rec.encrocam'
+        write_recording(fingerprint, gnupghome, path, minutes, total)
+        target = (minutes - 1) * 60
+
+        with open(path, 'rb') as infile, open(os.devnull, 'wb') as outfile, contextlib.redirect_stdout(io.StringIO()):
+            dc = EncroCrypt(fingerprint, gnupghome=gnupghome)
+            start = time.perf_counter()
+            dc.decrypt(infile, outfile, target)
+            seconds = time.perf_counter() - start
+        record('seek to the last minute, skip_until only', seconds * 1000, 'ms', f'{seconds * 1000:9.1f} ms')
+
+        start = time.perf_counter()
+        EncroIndex(path).rebuild()
+        seconds = time.perf_counter() - start
+        record('building the index', seconds * 1000, 'ms', f'{seconds * 1000:9.1f} ms')
+
+        with open(path, 'rb') as infile, open(os.devnull, 'wb') as outfile, contextlib.redirect_stdout(io.StringIO()):
+            dc = EncroCrypt(fingerprint, gnupghome=gnupghome)
+            start = time.perf_counter()
+            entry = EncroIndex(path).load().lookup(target)
+            dc.seek(infile, entry[1], entry[2])
+            dc.decrypt(infile, outfile, target)
+            seconds = time.perf_counter() - start
+        record('seek to the last minute, with the index', seconds * 1000, 'ms', f'{seconds * 1000:9.1f} ms')
+        print(f'{"":<48} (both include decrypting that minute, {total // minutes / 1e6:.1f} MB, and a GnuPG key decryption)')
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_resync(fingerprint, gnupghome, total):
+    # Garbage between two valid packets (like scripts/test-data-corruption.sh makes): how fast do we find the next packet?
+    ec = EncroCrypt(fingerprint, fingerprint, gnupghome)
+    encrypted = io.BytesIO()
+    ec.encrypt_into(b'before', encrypted)
+    encrypted.write(b'\x00' * total)
+    ec.encrypt_into(b'after', encrypted)
+
+    encrypted.seek(0)
+    decrypted = io.BytesIO()
+    dc = EncroCrypt(fingerprint, gnupghome=gnupghome)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        start = time.perf_counter()
+        dc.decrypt(encrypted, decrypted)
+        seconds = time.perf_counter() - start
+    if decrypted.getvalue() != b'beforeafter':
+        raise Exception('Did not recover from the corruption')
+    report('resync through garbage', total, seconds)
+
+
+def bench_overhead(fingerprint, gnupghome):
+    # What the container format adds to an hour of video: every encrypt call writes at least one packet with its own
+    # header, timestamp, nonce, and tag, so the overhead depends on encrypt_interval. Measured over a minute and scaled
+    # up. The key packet comes once per file (and per 2^32 packets), so it is listed separately.
+    with open(os.devnull, 'wb') as outfile:
+        for interval in INTERVALS:
+            ec = EncroCrypt(fingerprint, fingerprint, gnupghome)
+            key_packet = ec.encrypt_into(b'', outfile)
+            chunk = os.urandom(batch_size(interval))
+            written = sum(ec.encrypt_into(chunk, outfile) for _ in range(int(60 / interval)))
+            overhead = (written - len(chunk) * int(60 / interval)) * 60
+            record(f'storage overhead per hour, interval {interval} s', overhead, 'bytes', f'{overhead / 1e3:9.1f} kB ({overhead / BYTES_PER_HOUR * 100:.3f}% of {BYTES_PER_HOUR / 1e6:.0f} MB)')
+        record('key packet size', key_packet, 'bytes', f'{key_packet:9} bytes')
+
+
+def bench_newkey(fingerprint, gnupghome):
+    # What the first write of a file costs the recorder: wrapping a key with GnuPG, or taking one from a KeyPool
+    rounds = 10
+    with open(os.devnull, 'wb') as outfile:
+        pool = KeyPool(fingerprint, fingerprint, gnupghome)
+        for name, key_pool in [('wrapping the key', None), ('key from KeyPool', pool)]:
+            seconds = 0
+            for _ in range(rounds):
+                ec = EncroCrypt(fingerprint, fingerprint, gnupghome, key_pool=key_pool)
+                time.sleep(0.5)  # a file takes hours, so the pool has refilled by the time the next one starts
+                start = time.perf_counter()
+                ec.encrypt_into(b'x', outfile)
+                seconds += time.perf_counter() - start
+            record(f'first encrypt, {name}', seconds / rounds * 1000, 'ms', f'{seconds / rounds * 1000:9.1f} ms')
+
+
+def bench_upload(total):
+    # A recording growing by ~10 KB per encrypt_interval, uploaded as it grows: one long-lived append stream (what
+    # sync.py does) versus a new stream for every piece. The latency imitates a round trip to the server per operation.
+    tmpdir = tempfile.mkdtemp(prefix='encrocam-bench-')
+    try:
+        os.mkdir(f'{tmpdir}/local')
+        os.mkdir(f'{tmpdir}/remote')
+        for name, reopen in [('long-lived stream', False), ('new stream per piece', True)]:
+            fname = f'upload-{int(reopen)}.encrocam'
+            uploader = storage.Uploader(lambda: storage.LocalBackend(f'{tmpdir}/remote', latency=0.002), f'{tmpdir}/local')
+            with open(f'{tmpdir}/local/{fname}', 'wb') as recording:
+                start = time.perf_counter()
+                for chunk in chunks(10 * 1024, total):
+                    recording.write(chunk)
+                    recording.flush()
+                    uploader.upload(fname, reopen)
+                uploader.upload(fname, True)
+                seconds = time.perf_counter() - start
+            uploader.close()
+            if os.path.getsize(f'{tmpdir}/remote/{fname}') != os.path.getsize(f'{tmpdir}/local/{fname}'):
+                raise Exception('Upload is incomplete')
+            report(f'upload, {name}', total, seconds)
+            record(f'upload, {name}, streams opened', uploader.connections_opened, 'streams', f'{uploader.connections_opened:9} streams')
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+gnupghome, fingerprint = throwaway_gnupghome()
+gnupg_version = gnupg.GPG(gnupghome=gnupghome).version
+try:
+    bench_encrypt(fingerprint, gnupghome, megabytes * 1024 * 1024)
+    bench_decrypt(fingerprint, gnupghome, megabytes * 1024 * 1024)
+    bench_seek(fingerprint, gnupghome, megabytes * 1024 * 1024)
+    bench_resync(fingerprint, gnupghome, megabytes * 1024 * 1024)
+    bench_overhead(fingerprint, gnupghome)
+    bench_newkey(fingerprint, gnupghome)
+    bench_upload(megabytes * 1024 * 1024 // 16)  # the ~10 KB pieces make this one slow, and it's not about bulk speed
+finally:
+    shutil.rmtree(gnupghome, ignore_errors=True)
+
+if json_path is not None:
+    with open(json_path, 'w') as f:
+        json.dump({
+            'time': time.time(),
+            'megabytes': megabytes,
+            'python': platform.python_version(),
+            'pycryptodome': Cryptodome.__version__,
+            'gnupg': '.'.join(str(part) for part in gnupg_version),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'results': results,
+        }, f, indent=2)
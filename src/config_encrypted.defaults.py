@@ -1,19 +1,36 @@
 
 class Config:
     # settings for sync.py
+    storage_backend = 'ftps'  # Where to upload recordings to: 'ftps' (see the ftp_ settings), 's3' (S3 or S3-compatible object storage, see the s3_ settings; needs python3-boto3), or 'local' (a directory, such as a mounted network drive, see local_storage_dir)
     ftp_host = ''  # FTP server (hostname or FQDN) to connect to. Use empty string or None to not livestream the encrypted recording data.
     ftp_user = ''  # Username to log into the FTP server
     ftp_pass = ''  # Password to log into the FTP server
     ftp_dir = '/'  # Remote directory on the FTP server. This directory must exist and should ideally be dedicated for EncroCam so you can set remove_unrecognized_files to True
     ftp_timeout = 15  # seconds. Avoid indefinite network hangs. The timer seems to reset frequently (like with every network packet), so a few RTTs should be enough (a handful of seconds)
-    remove_unrecognized_files = True  # Remove any files (local and remote) whose name does not parse with filenameToTime()
+    s3_endpoint_url = ''  # Empty string for AWS, or the URL of an S3-compatible service
+    s3_bucket = ''  # Bucket to upload to. Use empty string or None to not livestream the encrypted recording data.
+    s3_access_key = ''
+    s3_secret_key = ''
+    s3_prefix = ''  # Prepended to the object names, e.g. 'encrocam/'
+    s3_part_size = 8 * 1024 * 1024  # bytes. Objects can't be appended to, only rewritten, so collect this much before uploading. Minimum 5 MiB; the remote copy lags behind by up to this much
+    local_storage_dir = ''  # For storage_backend 'local'. Use empty string or None to not copy the recording data anywhere.
+    remove_unrecognized_files = True  # Remove any files (local and remote) that aren't recordings: whose name does not parse with filenameToTime(), or does not have the extension of timeToFilename()'s names (like the .index files decrypter.py may leave next to recordings)
     keep_history_days = 7  # Automatically remove files (local and remote) that are older than...
     monitoring_url = ''  # URL to call to indicate to your uptime monitoring service that we're still online. Use empty string or None to turn off.
-    monitoring_interval = 60 * 29  # seconds interval between calling the service (may be delayed a few seconds depending on if it's busy uploading recording data)
-    logfile_dir = '__encrocam_homedir__/logs/'  # Where to write log files. The special value __encrocam_homedir__ gets replaced with the directory above where this configuration file is. Set to False (without quotes) to disable logging to file. Bit hacky, TODO we should probably use /var/log.
+    upload_coalesce_seconds = 1  # Collect file write events for this long before uploading the new data. Recording writes ~8 times per second (see encrypt_interval), so uploading once per second means fewer, larger writes at the cost of a second of latency
+    upload_blocksize = 64 * 1024  # bytes to send to the server at a time
+    backfill_connections = 2  # Extra connections used to upload past recordings that the server is missing (e.g. after an Internet outage), alongside the live upload
+    backfill_bandwidth_limit = 0  # bytes per second per backfill connection, so the live upload keeps enough bandwidth. 0 means unlimited
+    upload_retry_max_seconds = 60  # When uploads fail, retry after 1 second, then 2, 4, etc. up to this many seconds between attempts
+    monitoring_interval = 60 * 29  # seconds interval between calling the service (only while uploads succeed, or while recording if uploading is disabled)
+    logfile_dir = '__encrocam_homedir__/logs/'  # Where to write log files (one per weekday, so a week is kept; record.py and supervisor.py log here too). The special value __encrocam_homedir__ gets replaced with the directory above where this configuration file is. Set to False (without quotes) to disable logging to file. Bit hacky, TODO we should probably use /var/log.
+    metrics_dir = '__encrocam_homedir__/metrics/'  # Where sync.py and record.py write their metrics (bytes encrypted and uploaded, encrypt/write/upload timings, upload lag, etc.), as JSON and as .prom files for node_exporter's textfile collector. __encrocam_homedir__ works like for logfile_dir. Set to False (without quotes) to disable metrics
+    metrics_interval = 15  # seconds between writing the metrics files
+    metrics_port = 0  # If not 0, supervisor.py serves all processes' metrics in the Prometheus text format on http://127.0.0.1:<port>/metrics
 
     # settings for record.py
     hours_per_recording = 24  # Restart ffmpeg and start a new file every N hours, so you don't have to download many gigabytes of recording at once, and to prevent any ffmpeg memory leaks from messing things up (quick test in 2020: across 2.5h, it leaked about 6MB). Restarting leaves a ~4-second gap in the recording, so don't do this too often either
+    gapless_rotation = False  # Keep ffmpeg running when starting a new file, cutting its output at the first HLS segment after the hours_per_recording boundary, so that no frames are lost. The downside is that ffmpeg is then only restarted if it exits by itself, so any memory it leaks adds up
     input_device = '/dev/video0'
     input_format = 'v4l2'
     input_framerate = 30  # See v4l2-ctl --list-formats-ext for supported resolution+fps combinations
@@ -21,7 +38,13 @@ class Config:
     output_format = 'hls'  # HLS (HTTP Live Streaming) allows taking arbitrary cuts of the output file
     output_compression = 'faster'  # Tested to be very well within cpu tolerance of the Pi so it won't lag behind, and quite close to good compression
     output_keyframetime = 5  # Every how many seconds should a keyframe be written? Values <5 seem to result in significantly larger files. A lower value is useful for decrypting, since we can skip decrypting a section and it will result in only value/2 seconds of black screen on average. It does *not* mean we'll have gaps in the recording.
+    ffmpeg_stall_keyframes = 6  # Kill and restart ffmpeg when it wrote no video for this many times output_keyframetime (e.g. because the camera stopped delivering frames). Needed with gapless_rotation in particular, which otherwise never restarts ffmpeg. 0 to disable
     encrypt_interval = 1/8  # seconds to collect data from ffmpeg's stdout before encrypting it and writing it to a file. Shorter means more 'live' streaming, but also slightly more storage overhead
+    encrypt_max_bytes = 256 * 1024  # Encrypt and write sooner than encrypt_interval once this much data was collected. Also the most memory the capture buffer uses: if encrypting falls behind, ffmpeg waits
+    activity_interval = 10  # Every this many seconds, store how much the picture changed (the largest of ffmpeg's scene change scores between consecutive frames, 0 to 1, measured before the time overlay is drawn) in a small encrypted packet in the recording, about 80 bytes each. `decrypter.py --search` lists the active times from just these packets instead of decrypting the video. 0 to disable
+    key_pool_size = 1  # How many encryption keys to keep prepared (wrapped with GnuPG) in the background. One is plenty: a key is needed once per file
+    record_stats_interval = 3600  # seconds between log lines about how much was captured and how long encrypting and writing took. 0 to disable
+    cameras = []  # To record several cameras, list them here, e.g. [{'name': 'front', 'input_device': '/dev/video0'}, {'name': 'back', 'input_device': '/dev/video2', 'input_resolution': '640x480', 'cores': [2, 3]}]. Each one gets its own recording process, which uses the settings above unless the camera overrides them. The name (letters, digits, underscores) is added to its filenames; 'cores' pins the camera's recording and ffmpeg to those CPU cores. Empty means one camera, configured by the settings above
 
     # If you are looking for the recipients or signing fingerprint configuration
     # which was previously here, this moved to the unencrypted configuration.
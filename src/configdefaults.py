@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+# The user's configuration (encrypted_mountpoint/config.py) is a copy of config_encrypted.defaults.py from when EncroCam
+# was installed, and the installer does not touch it once it exists. Settings added since are therefore missing from it;
+# rather than crashing with an AttributeError, the scripts use the default value for those.
+
+import os, importlib.util
+
+
+def load():
+    """configdefaults.load() -> module
+    The default configuration, config_encrypted.defaults.py, as a module (its filename is not importable as such)"""
+    spec = importlib.util.spec_from_file_location('config_encrypted_defaults', os.path.dirname(os.path.abspath(__file__)) + '/config_encrypted.defaults.py')
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    return config
+
+
+def fill_in(config):
+    """configdefaults.fill_in(class) -> list
+    Sets every setting that the given Config class lacks to its default value. Settings that are present, even if set to
+    something the defaults would not use, are left alone. Returns the names of the settings that were filled in"""
+    missing = []
+    for setting, value in vars(load().Config).items():
+        if not setting.startswith('__') and not hasattr(config, setting):
+            setattr(config, setting, value)
+            missing.append(setting)
+    return missing
@@ -1,14 +1,329 @@
 #!/usr/bin/env python3
 
-import sys, time, datetime
-from EncroCrypt import EncroCrypt
+import sys, os, stat, time, json, datetime, tempfile, shutil, collections, concurrent.futures
+from EncroCrypt import EncroCrypt, KeyCache, FollowReader, warn
+from EncroIndex import EncroIndex
+from EncroServer import EncroServer
+import configdefaults
+
+
+def option(name, has_value=False):
+    # Removes the option (and its value) from sys.argv, such that only the positional arguments remain
+    if name not in sys.argv:
+        return None
+    i = sys.argv.index(name)
+    if not has_value:
+        del sys.argv[i]
+        return True
+    if i + 1 >= len(sys.argv):
+        print(f'Option {name} needs a value, please use --help')
+        exit(1)
+    value = sys.argv[i + 1]
+    del sys.argv[i : i + 2]
+    return value
+
+
+def parseTime(text):
+    # YYYY-MM-DDTHH:MM in local time -> unix timestamp
+    return time.mktime(datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M').timetuple())
+
+
+def seekWithIndex(ec, infile, path, timestamp):
+    # Positions infile at the last indexed minute at or before the timestamp, if there is one
+    index = EncroIndex(path).load()
+    entry = index.lookup(timestamp)
+    if entry is not None and not index.valid(infile, entry):
+        warn('Index entry does not match the recording, rebuilding the index')
+        entry = index.rebuild().lookup(timestamp)
+    if entry is not None:
+        ec.seek(infile, entry[1], entry[2])
+
+
+def recordings(directory, start, end, camera):
+    # The recordings in the directory whose time slot (according to their filename) overlaps [start, end), oldest first.
+    # The filename functions come from the default configuration, the same ones record.py and sync.py use.
+    config = configdefaults.load()
+    if hours_per_recording is not None:
+        config.Config.hours_per_recording = float(hours_per_recording)
+
+    selected = []
+    for fname in os.listdir(directory):
+        base, extension = os.path.splitext(fname)
+        if extension != '.encrocam' or base.split('-', 2)[2 : ] != ([] if camera is None else [camera]):
+            continue  # not a recording, or of another camera (rec-<slot>-<camera>.encrocam)
+        try:
+            filestart = config.filenameToTime(fname)
+        except (IndexError, ValueError):
+            continue
+        if filestart < end and filestart + config.Config.hours_per_recording * 3600 > start:
+            selected.append((filestart, f'{directory}/{fname}'))
+    return [path for filestart, path in sorted(selected)]
+
+
+def decryptRange(path, start, end):
+    # Decrypts the part of one recording between the timestamps into a temporary file, and returns that file
+    decrypted = tempfile.TemporaryFile()
+    ec = EncroCrypt(signing_fingerprint=fingerprint, key_cache=key_cache)
+    with open(path, 'rb') as infile:
+        seekWithIndex(ec, infile, path, start)
+        ec.decrypt(infile, decrypted, start, stop_at=end)
+    decrypted.seek(0)
+    return decrypted
+
+
+class NullOutput:
+    # Where --verify writes the plaintext: it only needs to be authenticated, not kept
+    def write(self, data):
+        return len(data)
+
+
+    def flush(self):
+        pass
+
+
+def verifyFile(path):
+    # Returns (packets verified, sorted verified minutes, problems Counter, first offset per problem, error or None)
+    ec = EncroCrypt(signing_fingerprint=fingerprint, key_cache=key_cache)
+    ec.verbose = False
+    error = None
+    with open(path, 'rb') as infile:
+        try:
+            ec.decrypt(infile, NullOutput())
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+    return ec.packets_verified, sorted(ec.verified_minutes), ec.problems, ec.first_problem_offset, error
+
+
+def minuteText(minute):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(minute * 60))
+
+
+def encrocamFiles(paths):
+    # The given files, and the .encrocam files in the given directories
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(f'{path}/{fname}' for fname in os.listdir(path) if fname.endswith('.encrocam'))
+        else:
+            files.append(path)
+    return files
+
+
+def cameraOf(path):
+    # () for rec-<slot>.encrocam, ('front',) for rec-<slot>-front.encrocam
+    return tuple(os.path.splitext(os.path.basename(path))[0].split('-', 2)[2 : ])
+
+
+def verify(paths):
+    files = encrocamFiles(paths)
+
+    # Check the files on `jobs` threads, but report in order
+    findings = 0
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(verifyFile, path) for path in files]
+        for path, future in zip(files, futures):
+            packets, minutes, problems, first_offset, error = future.result()
+            results[path] = minutes
+            line = f'{path}: {packets} packets verified'
+            if len(minutes) > 0:
+                line += f', {len(minutes)} minute(s) from {minuteText(minutes[0])} to {minuteText(minutes[-1])}'
+            issues = [f'{kind}: {count} (first at byte {first_offset[kind]})' for kind, count in sorted(problems.items())]
+            if error is not None:
+                issues.append(error)
+            print(line + ''.join('; ' + issue for issue in issues) + ('' if len(issues) > 0 else '; OK'), flush=True)
+            findings += len(issues)
+
+    # Minutes without video, within and between the recordings of each camera (rec-<slot>-<camera>.encrocam)
+    cameras = collections.defaultdict(list)
+    for path, minutes in results.items():
+        if len(minutes) > 0:
+            cameras[cameraOf(path)].append((minutes, path))
+    for camera, recordings in sorted(cameras.items()):
+        previous, previous_path = None, None
+        for minutes, path in sorted(recordings):
+            for minute in minutes:
+                if previous is not None and minute > previous + 1:
+                    where = f'in {path}' if path == previous_path else f'between {previous_path} and {path}'
+                    print(f'Gap: no video from {minuteText(previous + 1)} to {minuteText(minute - 1)} ({minute - previous - 1} minutes) {where}')
+                    findings += 1
+                previous, previous_path = minute, path
+
+    print(f'Verified {len(files)} recording(s): ' + (f'{findings} problem(s) or gap(s) found' if findings > 0 else 'everything is intact'))
+    return findings == 0
+
+
+def searchFile(path):
+    # Returns the (start, seconds, activity score) of every metadata packet with an activity score in the recording, and
+    # how many metadata packets could not be authenticated. Only those packets and their key packets are read: the index
+    # knows where they are.
+    ec = EncroCrypt(signing_fingerprint=fingerprint, key_cache=key_cache)
+    intervals = []
+    failures = 0
+    key_offset = None
+    with open(path, 'rb') as infile:
+        for minute, entry_key_offset, offset in EncroIndex(path).load().metadata:
+            try:
+                if entry_key_offset != key_offset:
+                    key_offset = entry_key_offset
+                    ec.seek(infile, key_offset, offset)
+                packet_type, timestamp, plaintext = ec.decrypt_packet(infile, offset)
+            except Exception:
+                failures += 1
+                continue
+            if plaintext is None:
+                failures += 1
+                continue
+            metadata = json.loads(plaintext)
+            if 'activity' in metadata:
+                intervals.append((metadata['start'], metadata['seconds'], metadata['activity']))
+    return intervals, failures
+
+
+def search(paths, threshold):
+    files = encrocamFiles(paths)
+    cameras = collections.defaultdict(list)
+    packets = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(searchFile, path) for path in files]
+        for path, future in zip(files, futures):
+            intervals, failures = future.result()
+            packets += len(intervals)
+            if failures > 0:
+                warn(f'{path}: {failures} activity packet(s) failed to verify and were skipped, see --verify')
+            if len(intervals) == 0 and failures == 0:
+                warn(f'{path}: no activity information (recorded with activity_interval = 0, or before it existed)')
+            cameras[cameraOf(path)] += intervals
+
+    # Active intervals that follow each other (give or take a second) are one range
+    found = 0
+    for camera, intervals in sorted(cameras.items()):
+        ranges = []  # [start, end, highest score]
+        for start, seconds, score in sorted(intervals):
+            if score < threshold:
+                continue
+            if len(ranges) > 0 and start <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], start + seconds)
+                ranges[-1][2] = max(ranges[-1][2], score)
+            else:
+                ranges.append([start, start + seconds, score])
+        for start, end, score in ranges:
+            print(('[' + camera[0] + '] ' if len(camera) > 0 else '') + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))
+                + time.strftime(' to %H:%M:%S', time.localtime(end)) + f' ({round(end - start)} seconds), activity up to {score:.3f}', flush=True)
+        found += len(ranges)
+
+    print(f'Searched {len(files)} recording(s), {packets} activity packet(s): {found} time range(s) with activity of at least {threshold}')
+
+
+def export(directory, output_path, start, end, camera):
+    paths = recordings(directory, start, end, camera)
+    if len(paths) == 0:
+        print(f'No recordings in {directory} between {time.ctime(start)} and {time.ctime(end)}')
+        exit(1)
+    warn(f'Exporting from {len(paths)} recording(s): ' + ', '.join(os.path.basename(path) for path in paths))
+
+    # Up to `jobs` files are decrypted at the same time; the output is written in order as each one finishes
+    with open(output_path, 'wb') as outfile, concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = collections.deque()
+        for path in paths + [None] * jobs:
+            if path is not None:
+                running.append(executor.submit(decryptRange, path, start, end))
+            if len(running) > 0 and (path is None or len(running) >= jobs):
+                with running.popleft().result() as decrypted:
+                    shutil.copyfileobj(decrypted, outfile)
+
+
+key_cache_path = option('--key-cache', True)
+key_cache_recipient = option('--key-cache-for', True)
+prefetch_keys = option('--prefetch-keys')
+jobs = int(option('--jobs', True) or 1)
+serve_port = option('--serve', True)
+cache_megabytes = int(option('--cache-mb', True) or 256)
+follow = option('--follow')
+export_directory = option('--export', True)
+hours_per_recording = option('--hours-per-recording', True)
+camera = option('--camera', True)
+verify_only = option('--verify')
+search_only = option('--search')
+threshold = float(option('--threshold', True) or 0.02)
+
+if len(sys.argv) >= 3 and sys.argv[1] == '--rebuild-index':
+    for path in sys.argv[2 : ]:
+        index = EncroIndex(path).rebuild()
+        print(f'{path}: indexed {len(index.entries)} minutes in {index.indexed_until} bytes')
+    exit(0)
+
+if (key_cache_path is None) != (key_cache_recipient is None):
+    print('--key-cache and --key-cache-for must be used together, please use --help')
+    exit(1)
+
+if verify_only and len(sys.argv) >= 3 and '-h' not in sys.argv and '--help' not in sys.argv:
+    fingerprint = sys.argv[1]
+    key_cache = KeyCache()
+    gpg = EncroCrypt(fingerprint).gpg
+    if key_cache_path is not None:
+        key_cache.load(key_cache_path, gpg, key_cache_recipient)
+    try:
+        intact = verify(sys.argv[2 : ])
+    finally:
+        if key_cache_path is not None:
+            key_cache.save(key_cache_path, gpg, key_cache_recipient)
+    exit(0 if intact else 1)
+
+if search_only and len(sys.argv) >= 3 and '-h' not in sys.argv and '--help' not in sys.argv:
+    fingerprint = sys.argv[1]
+    key_cache = KeyCache()
+    gpg = EncroCrypt(fingerprint).gpg
+    if key_cache_path is not None:
+        key_cache.load(key_cache_path, gpg, key_cache_recipient)
+    try:
+        search(sys.argv[2 : ], threshold)
+    finally:
+        if key_cache_path is not None:
+            key_cache.save(key_cache_path, gpg, key_cache_recipient)
+    exit(0)
+
+if export_directory is not None and len(sys.argv) == 5 and '-h' not in sys.argv and '--help' not in sys.argv:
+    fingerprint = sys.argv[2]
+    key_cache = KeyCache()
+    if key_cache_path is not None:
+        key_cache.load(key_cache_path, EncroCrypt(fingerprint).gpg, key_cache_recipient)
+    try:
+        export(export_directory, sys.argv[1], parseTime(sys.argv[3]), parseTime(sys.argv[4]), camera)
+    finally:
+        if key_cache_path is not None:
+            key_cache.save(key_cache_path, EncroCrypt(fingerprint).gpg, key_cache_recipient)
+    exit(0)
+
+if serve_port is not None and len(sys.argv) == 3 and '-h' not in sys.argv and '--help' not in sys.argv:
+    key_cache = KeyCache()
+    server = EncroServer(sys.argv[1], sys.argv[2], key_cache, cache_megabytes * 1024 * 1024, jobs)
+    if key_cache_path is not None:
+        key_cache.load(key_cache_path, server.ec.gpg, key_cache_recipient)
+    try:
+        server.serve(int(serve_port))
+    finally:
+        if key_cache_path is not None:
+            key_cache.save(key_cache_path, server.ec.gpg, key_cache_recipient)
+    exit(0)
 
 if len(sys.argv) < 4 or '-h' in sys.argv or '--help' in sys.argv:
     print("""
 Usage:
-  1. {self} <input.encrocam> <output.hls> <verification_fingerprint> [Seek]
+  1. {self} [Options] <input.encrocam> <output.hls> <verification_fingerprint> [Seek]
   2. vlc output.hls #streamable, can be started after a second of decrypting
 
+  {self} --rebuild-index <input.encrocam> [...]
+
+  {self} [Options] --verify <verification_fingerprint> <input.encrocam or directory> [...]
+
+  {self} [Options] --search <verification_fingerprint> <input.encrocam or directory> [...]
+
+  {self} [Options] --export <directory> <output.hls> <verification_fingerprint> <Start> <End>
+
+  {self} [Options] --serve <port> <input.encrocam> <verification_fingerprint>
+  vlc http://127.0.0.1:<port>/index.m3u8
+
 <input.encrocam>: the encrypted recording.
 
 <output.hls>: the decrypted file (will be in HTTP Live Streaming format).
@@ -23,6 +338,75 @@ If given, it will decrypt only video data from that time onward. Note that, to
 make seeking faster, the timestamps are not verified. Only the in-video time
 overlay is authenticated. Malicious storage could thus break the seeking
 feature, but you will notice it in the video itself.
+When the input is a regular file, seeking uses an index that is stored next to
+it as <input.encrocam>.index. It is created on first use, extended when the
+recording grew, and rebuilt if it does not match the recording anymore. Use
+--rebuild-index to (re)create it up front, e.g. for existing recordings.
+
+--verify: check that recordings are intact without writing the video anywhere:
+every video data packet is authenticated and every key packet's signature is
+checked. Prints per recording how much video it has and any problems (MAC
+failures, missing packets, corrupted data that had to be skipped, cut-offs),
+followed by the gaps in the recording time per camera, which may mean that
+the camera was tampered with. For directories, all .encrocam files in it are
+checked. Exits with status 1 if anything was found, so it can run nightly on
+the storage server. --jobs checks that many recordings at the same time.
+
+--search: list the times with activity (something moving in the picture)
+without decrypting the video. While recording, every activity_interval seconds
+(see the configuration) a small packet with how much the picture changed is
+added to the recording; this decrypts only those packets, a few kilobytes per
+hour of video, with the index (see Seek) telling where they are. Prints one
+line per time range (per camera) in which the activity score reached
+--threshold. The score is the largest change between two frames, from 0 to 1:
+noise in a still picture scores far lower than someone walking through. Then
+decrypt the part you're interested in with Seek or --export. The scores are
+authenticated like the video.
+
+--export <directory>: decrypt the video from Start until End (same format as
+Seek) into one output file, from all recordings in the directory that cover
+that time range. Only the needed part of each recording is decrypted, and with
+--jobs, that many recordings are decrypted at the same time. If the recordings
+were made with a different hours_per_recording setting than the default, pass
+it with --hours-per-recording <N>. With several cameras, choose one with
+--camera <name>.
+
+--serve <port>: instead of decrypting to a file, serve the recording on
+http://127.0.0.1:<port>/index.m3u8 as an HLS playlist of one-minute segments.
+Only the minutes that the player asks for are decrypted. To limit the playlist
+to a time range, add ?start=YYYY-MM-DDTHH:MM and/or &end=YYYY-MM-DDTHH:MM. If
+the recording is still being written to (or synchronized), the playlist grows
+along with it, about two minutes behind.
+
+Options:
+  --key-cache <file> --key-cache-for <fingerprint>
+      Remember the decrypted symmetric keys in <file>, encrypted for and
+      signed by the given PGP key (you need its secret key), so that the next
+      run over the same recording does not need a GnuPG private key operation
+      for every key packet. Only keys with a valid signature are stored, and a
+      cache file that is not signed by that key is ignored. Opt-in because it
+      keeps keys on disk (encrypted).
+  --prefetch-keys
+      Decrypt all key packets of the input file up front, several GnuPG
+      processes at a time, instead of one by one as they are encountered.
+      Requires the input to be a regular file (uses the index, see Seek).
+  --jobs <N>
+      Verify and decrypt on N threads (default: 1). The output is the same,
+      but decrypting long recordings is faster on multi-core machines. With
+      --export, --verify, or --search, the number of recordings to do at the
+      same time instead.
+  --follow
+      When reaching the end of the input, wait for more data instead of
+      stopping, like `tail -f`, until interrupted with Ctrl+C. For watching the
+      current recording (or its copy on the server) as it is being written:
+      combine with Seek to start near the end, and play the output while it is
+      being written. The input must be a regular file.
+  --threshold <score>
+      With --search, the lowest activity score that counts as activity
+      (default: 0.02).
+  --cache-mb <N>
+      With --serve, keep up to N megabytes (default: 256) of recently decrypted
+      video in memory, so that seeking back does not decrypt it again.
 
 If you need a custom GnuPG home directory, set the GNUPGHOME environment
 variable.
@@ -37,14 +421,43 @@ You can also pass data from stdin and write to stdout or other kinds of pipes:
 
 seek = -1
 if len(sys.argv) == 5:
-    d = datetime.datetime.strptime(sys.argv[4], '%Y-%m-%dT%H:%M')
-    seek = time.mktime(d.timetuple())
+    seek = parseTime(sys.argv[4])
 elif len(sys.argv) != 4:
     print('Invalid number of arguments, please use --help')
     exit(1)
 
-ec = EncroCrypt(signing_fingerprint=sys.argv[3])
+key_cache = None
+if key_cache_path is not None:
+    key_cache = KeyCache()
+
+ec = EncroCrypt(signing_fingerprint=sys.argv[3], key_cache=key_cache)
+if key_cache is not None:
+    key_cache.load(key_cache_path, ec.gpg, key_cache_recipient)
 
 with open(sys.argv[1], 'rb') as infile, open(sys.argv[2], 'wb') as outfile:
-    ec.decrypt(infile, outfile, seek)
+    seekable = stat.S_ISREG(os.fstat(infile.fileno()).st_mode)
+    if prefetch_keys:
+        if not seekable:
+            print('--prefetch-keys needs the input to be a regular file')
+            exit(1)
+        index = EncroIndex(sys.argv[1]).load()
+        ec.prefetch_keys(infile, sorted(set(entry[1] for entry in index.entries)))
+
+    if seek != -1 and seekable:
+        seekWithIndex(ec, infile, sys.argv[1], seek)
+
+    if follow:
+        if not seekable:
+            print('--follow needs the input to be a regular file (pipes already wait for more data)')
+            exit(1)
+        infile = FollowReader(infile, on_wait=ec.flush_output)
+
+    try:
+        ec.decrypt(infile, outfile, seek, jobs)
+    except KeyboardInterrupt:
+        if not follow:
+            raise
+    finally:
+        if key_cache is not None:
+            key_cache.save(key_cache_path, ec.gpg, key_cache_recipient)
 
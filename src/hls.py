@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# What ffmpeg writes when outputting HLS to a pipe: each transport stream segment, followed by the playlist so far (text
+# that starts with #EXTM3U). The next segment then starts with a transport stream packet: sync byte G, then a byte with
+# the payload start flag: @. A segment starts with a keyframe, so it can be played from its first byte. record.py cuts
+# files there (gapless_rotation) and EncroServer.py serves the segments without the playlists in between.
+
+PLAYLIST_START = b'#EXTM3U'
+SEGMENT_START = b'G@'
+
+
+def segment_after_playlist(buf, start, end):
+    # Where the segment after the playlist we are in starts (the packet after a newline), or -1 if not in buf[start:end]
+    pos = buf.find(b'\n' + SEGMENT_START, start, end)
+    return -1 if pos == -1 else pos + 1
+
+
+def pieces(data):
+    """
+    hls.pieces(bytes) -> [(bool, int, int)]
+    Splits ffmpeg's HLS output into (is playlist, start, end) pieces.
+    """
+    result = []
+    pos = 0
+    while pos < len(data):
+        start = data.find(PLAYLIST_START, pos)
+        if start == -1:
+            result.append((False, pos, len(data)))
+            break
+        if start > pos:
+            result.append((False, pos, start))
+        end = segment_after_playlist(data, start, len(data))
+        end = len(data) if end == -1 else end
+        result.append((True, start, end))
+        pos = end
+    return result
+
+
+class SegmentFinder:
+    """
+    Finds where the next segment starts in ffmpeg's HLS output as it is being read, so the playlist may arrive split
+    over several reads.
+    """
+
+    def __init__(self):
+        self.in_playlist = False
+        self.newline_at_end = False
+
+
+    def find(self, buf, start, end):
+        """
+        finder_obj.find(bytearray, int, int) -> int or None
+        Returns where a segment starts in the newly read data buf[start:end], or None
+        """
+        if not self.in_playlist:
+            pos = buf.find(PLAYLIST_START, start, end)
+            if pos == -1:
+                return None
+            self.in_playlist = True
+            start = pos
+        elif self.newline_at_end and buf[start : start + len(SEGMENT_START)] == SEGMENT_START:
+            return start
+
+        pos = segment_after_playlist(buf, start, end)
+        if pos != -1:
+            return pos
+        self.newline_at_end = buf[end - 1 : end] == b'\n'
+        return None
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import sys, os, time, atexit, threading  # stdlib imports
+
+
+class LogFile:
+    """
+    Log file that stays open between messages, rather than opening and closing the file for every line. Writes are
+    buffered and reach the disk at the latest flush_seconds later, or right away for urgent messages (errors).
+    There is one file per weekday, {directory}/{Weekday}-{name}.log, and a file is started over when its weekday comes
+    around again, so a week of logs is kept. Safe to use from several threads.
+    """
+
+    def __init__(self, directory, name, flush_seconds=5):
+        self.directory = directory
+        self.name = name
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.fp = None
+        self.weekday = None
+        self.timer = None  # pending flush
+        atexit.register(self.close)
+
+
+    def _open(self):
+        weekday = time.strftime('%A')
+        if self.fp is not None and weekday == self.weekday:
+            return
+        if self.fp is not None:
+            self.fp.close()
+
+        path = f'{self.directory}/{weekday}-{self.name}.log'
+        mode = 'at'
+        if os.path.exists(path) and os.path.getmtime(path) < time.time() - 24 * 3600:
+            mode = 'wt'  # last week's file
+        self.fp = open(path, mode, encoding='UTF-8')
+        self.weekday = weekday
+
+
+    def write(self, message, urgent=False):
+        """
+        logfile_obj.write(string, bool)
+        Appends the message (which should include its newline, if any) to today's file.
+        """
+        with self.lock:
+            self._open()
+            self.fp.write(message)
+            if urgent:
+                self.fp.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_seconds, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if self.fp is not None:
+                self.fp.flush()
+
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+
+def setup_directories(config, encrocam_homedir):
+    """
+    logfile.setup_directories(class, string)
+    Makes the logfile_dir and metrics_dir settings of the Config class ready for use: __encrocam_homedir__ is replaced
+    and the directory created if it doesn't exist. If that fails, the setting is set to False, which disables it.
+    """
+    for setting in ['logfile_dir', 'metrics_dir']:
+        if getattr(config, setting) != False:
+            directory = getattr(config, setting).replace('__encrocam_homedir__', encrocam_homedir)
+            try:
+                os.makedirs(directory, exist_ok=True)
+                setattr(config, setting, directory)
+            except OSError as e:
+                print(f'Failed to create {directory} ({type(e).__name__}: {e}), disabling {setting}', file=sys.stderr, flush=True)
+                setattr(config, setting, False)
+
+
+def make_tprint(directory, name, prefix='', urgent=False):
+    """
+    logfile.make_tprint(string or False, string, string, bool) -> function
+    Returns the scripts' tprint(msg, printfunc=print), which prints the message with the time and `prefix` in front and
+    appends it to the LogFile `name` in `directory` (unless that is False). Errors are passed with
+    printfunc=sys.stderr.write and include their own newline; those are written to disk right away, as is everything
+    if `urgent` is set.
+    """
+    logfile = LogFile(directory, name) if directory != False else None
+
+    def tprint(msg, printfunc=print):
+        msgwithtime = time.strftime('%a %d %b %H:%M:%S %z', time.localtime()) + ' ' + prefix + msg
+        if printfunc == print:
+            print(msgwithtime, flush=True)  # stdout is a pipe when started by start.bash, which would hold on to it
+        else:
+            printfunc(msgwithtime)
+        if logfile is not None:
+            logfile.write(msgwithtime + ('\n' if printfunc == print else ''), urgent=urgent or printfunc != print)
+
+    return tprint
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import os, json, time, threading, http.server  # stdlib imports
+
+
+class Metric:
+    def __init__(self, name, help, kind, function=None):
+        self.name = name
+        self.help = help
+        self.kind = kind  # Prometheus metric type: counter, gauge, or histogram
+        self.lock = threading.Lock()
+        self.value = 0
+        self.function = function  # if given, called for the current value whenever the metrics are written, for values that are counted elsewhere anyway
+
+
+    def samples(self):
+        return [(self.name, {}, self.function() if self.function is not None else self.value)]
+
+
+class Counter(Metric):
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help, 'counter', function)
+
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge(Metric):
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help, 'gauge', function)
+
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets):
+        super().__init__(name, help, 'histogram')
+        self.buckets = sorted(buckets)  # upper bounds; the +Inf bucket is implicit
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+    def samples(self):
+        with self.lock:
+            samples = [(self.name + '_bucket', {'le': repr(float(bound))}, count) for bound, count in zip(self.buckets, self.counts)]
+            samples.append((self.name + '_bucket', {'le': '+Inf'}, self.count))
+            samples.append((self.name + '_sum', {}, self.sum))
+            samples.append((self.name + '_count', {}, self.count))
+        return samples
+
+
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Registry:
+    """
+    The metrics of one process (record.py for one camera, or sync.py). write() stores them in a directory as JSON
+    (<process>.json) and in the Prometheus text format (<process>.prom, which node_exporter's textfile collector can
+    pick up); supervisor.py can also serve all processes' metrics over HTTP, see serve_directory().
+    All samples get a process label, so that the same metric from several processes can be told apart.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.metrics = []
+
+
+    def counter(self, name, help, function=None):
+        return self._add(Counter(name, help, function))
+
+
+    def gauge(self, name, help, function=None):
+        return self._add(Gauge(name, help, function))
+
+
+    def histogram(self, name, help, buckets=SECONDS_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def families(self):
+        """
+        registry_obj.families() -> dict
+        Returns {metric name: {'type': string, 'help': string, 'samples': [[sample name, {label: value}, number]]}}
+        """
+        families = {}
+        for metric in self.metrics:
+            samples = [[name, dict(labels, process=self.process), value] for name, labels, value in metric.samples()]
+            families[metric.name] = {'type': metric.kind, 'help': metric.help, 'samples': samples}
+        return families
+
+
+    def write(self, directory):
+        families = self.families()
+        for extension, content in [('json', json.dumps({'time': time.time(), 'metrics': families})), ('prom', render(families))]:
+            path = f'{directory}/{self.process}.{extension}'
+            with open(path + '.tmp', 'w') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)  # readers never see a half-written file
+
+
+    def start_writing(self, directory, interval):
+        """
+        registry_obj.start_writing(string, float)
+        Calls write() every `interval` seconds on a background thread. Errors are not fatal: metrics are not worth
+        disturbing the recording for.
+        """
+        def run():
+            while True:
+                try:
+                    self.write(directory)
+                except OSError:
+                    pass
+                time.sleep(interval)
+        threading.Thread(target=run, daemon=True).start()
+
+
+def render(families):
+    """
+    metrics.render(dict) -> string
+    Formats metric families (see Registry.families()) in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, family in families.items():
+        lines.append(f'# HELP {name} {family["help"]}')
+        lines.append(f'# TYPE {name} {family["type"]}')
+        for sample_name, labels, value in family['samples']:
+            labeltext = ','.join(f'{label}="{labelvalue}"' for label, labelvalue in labels.items())
+            lines.append(f'{sample_name}{{{labeltext}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def read_directory(directory, max_age):
+    """
+    metrics.read_directory(string, float) -> dict
+    Merges the metric families from all processes' JSON files in the directory, skipping files that were not updated in
+    the last max_age seconds (the process is gone).
+    """
+    merged = {}
+    for fname in sorted(os.listdir(directory)):
+        if not fname.endswith('.json'):
+            continue
+        try:
+            with open(f'{directory}/{fname}') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if data['time'] < time.time() - max_age:
+            continue
+        for name, family in data['metrics'].items():
+            if name in merged:
+                merged[name]['samples'] += family['samples']
+            else:
+                merged[name] = family
+    return merged
+
+
+def serve_directory(directory, port, max_age):
+    """
+    metrics.serve_directory(string, int, float)
+    Serves the merged metrics of all processes (see read_directory()) on http://127.0.0.1:<port>/metrics, on a
+    background thread.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = render(read_directory(directory, max_age)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # don't print every scrape
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
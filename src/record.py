@@ -1,82 +1,424 @@
 #!/usr/bin/env python3
 
-import sys, time, os, fcntl, subprocess
-from EncroCrypt import EncroCrypt
+import sys, time, os, subprocess, selectors, fcntl, termios, array, signal
+from EncroCrypt import EncroCrypt, KeyPool
+from logfile import setup_directories, make_tprint
+from hls import SegmentFinder
+import metrics
 sys.path.append('../')
 from encrypted_mountpoint.config import *
+import configdefaults
+configdefaults.fill_in(Config)  # config.py may be older than some settings, those get their default value (supervisor.py lists them)
 
 encrocam_homedir = sys.argv[1]
 signing_fingerprint = sys.argv[2]
 encrypt_fingerprint = sys.argv[3]
 recordings_directory = sys.argv[4]
+camera = sys.argv[5] if len(sys.argv) > 5 else None  # name of one of Config.cameras, when started by supervisor.py
 
 gnupghome = f'{encrocam_homedir}/encrypted_mountpoint/gpg_homedir'
 
-starttime = None
-remainingSeconds = None
-while True:
-    # Need to reinstantiate because the output file may have changed and this ensures it writes a key packet before any data packets
-    ec = EncroCrypt(signing_fingerprint, encrypt_fingerprint, gnupghome)
+if camera is not None:
+    # The camera's own settings take precedence over the general ones
+    definitions = [definition for definition in Config.cameras if definition['name'] == camera]
+    if len(definitions) == 0:
+        print(f'Camera {camera} is not in the cameras setting')
+        exit(1)
+    for setting, value in definitions[0].items():
+        if setting not in ['name', 'cores']:
+            setattr(Config, setting, value)
 
-    stderr = subprocess.DEVNULL
-    # To align the files to their supposed start time, compute the remaining time for this time slot
-    oddly_short_threshold = 31  # seonds
-    if starttime is not None and time.time() - oddly_short_threshold < starttime and remainingSeconds is not None and remainingSeconds > oddly_short_threshold:
-        # ffmpeg ran for very little time, but was supposed to run for more than that? Let's see what's happening
-        stderr = None  # causes it to be printed
 
-    # To align the files to their supposed start time, compute the remaining time for this time slot
-    starttime = time.time()
-    seconds_per_file = Config.hours_per_recording * 3600
-    remainingSeconds = seconds_per_file - (starttime % seconds_per_file)
-    filename = recordings_directory + '/' + timeToFilename(starttime)
-    # TODO implement logging like in sync.py, or even use the proper stdin logging with rotation like described in https://stackoverflow.com/a/9107096/1201863
-    print(time.strftime('%a %d %b %H:%M:%S %z', time.localtime()) + f' Starting recording for {round(remainingSeconds/3600, 3)} hours to {filename}')
+process_name = 'record' if camera is None else f'record-{camera}'  # for the log file and metrics
+setup_directories(Config, encrocam_homedir)  # normally sync.py and supervisor.py already created them
+tprint = make_tprint(Config.logfile_dir, process_name, f'[{camera}] ' if camera is not None else '')
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))  # exit normally when stopped (with the usual status), so the log file gets flushed
+
+
+def recordingFilename(timestamp):
+    # With several cameras, rec-123.encrocam becomes rec-123-front.encrocam: filenameToTime() parses that the same way,
+    # so sync.py uploads and cleans up all cameras' recordings from the one directory
+    base, extension = os.path.splitext(timeToFilename(timestamp))
+    if camera is not None:
+        base += '-' + camera
+    return recordings_directory + '/' + base + extension
+
+
+class TimedWriter:
+    # Wraps the output file so we can tell how much of encrypt_into() was spent writing rather than encrypting
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.seconds = 0
+
+
+    def write(self, data):
+        start = time.perf_counter()
+        written = self.outfile.write(data)
+        self.seconds += time.perf_counter() - start
+        return written
+
+
+class CaptureStats:
+    """
+    Counts what the capture loop did since the last report: bytes read from ffmpeg, how many times we encrypted and
+    why (buffer full or encrypt_interval passed), the time spent encrypting and writing, and how full ffmpeg's pipe got
+    meanwhile (if it is full, ffmpeg has to wait for us). Also reports the frames that ffmpeg encoded and dropped, and
+    the key pool's GnuPG timings. Reported every record_stats_interval seconds, so you can see whether the Pi keeps up
+    and tune encrypt_interval/encrypt_max_bytes.
+    """
+
+    def __init__(self):
+        self.reset()
+        self.new_ffmpeg()
+
+
+    def new_ffmpeg(self):
+        # ffmpeg's frame counts are totals since it started
+        self.ffmpeg_frames = 0
+        self.ffmpeg_frames_dropped = 0
+        self.progress_partial = b''
+
+
+    def reset(self):
+        self.started = time.time()
+        self.bytes_captured = 0
+        self.flushes = 0
+        self.flushes_full = 0
+        self.encrypt_seconds = 0
+        self.write_seconds = 0
+        self.pipe_queued_max = 0
+        self.pipe_full = 0
+        self.frames = 0
+        self.frames_dropped = 0
+        key_pool.reset_stats()
+
+
+    def flushed(self, nbytes, full, seconds, write_seconds, pipe_queued):
+        self.bytes_captured += nbytes
+        self.flushes += 1
+        self.flushes_full += 1 if full else 0
+        self.encrypt_seconds += seconds - write_seconds
+        self.write_seconds += write_seconds
+        self.pipe_queued_max = max(self.pipe_queued_max, pipe_queued)
+        self.pipe_full += 1 if pipe_queued >= pipe_size else 0
+
+
+    def progress(self, data):
+        # ffmpeg's -progress output: blocks of key=value lines
+        lines = (self.progress_partial + data).split(b'\n')
+        self.progress_partial = lines.pop()
+        for line in lines:
+            key, _, value = line.partition(b'=')
+            if not value.strip().isdigit():
+                continue
+            if key == b'frame':
+                self.frames += int(value) - self.ffmpeg_frames
+                frames_encoded.inc(int(value) - self.ffmpeg_frames)
+                self.ffmpeg_frames = int(value)
+            elif key == b'drop_frames':
+                self.frames_dropped += int(value) - self.ffmpeg_frames_dropped
+                frames_dropped.inc(int(value) - self.ffmpeg_frames_dropped)
+                self.ffmpeg_frames_dropped = int(value)
+
+
+    def report_if_due(self, force=False):
+        if Config.record_stats_interval <= 0 or (not force and time.time() < self.started + Config.record_stats_interval):
+            return
+        seconds = time.time() - self.started
+        tprint(f'Captured {self.bytes_captured} bytes in {round(seconds)} seconds ({round(self.bytes_captured / max(1, seconds) / 1000)} kB/s), '
+            + f'{self.frames} frames ({self.frames_dropped} dropped by ffmpeg), '
+            + f'{self.flushes} encrypt+write calls ({self.flushes_full} with a full buffer), '
+            + f'{round(self.encrypt_seconds * 1000)} ms encrypting, {round(self.write_seconds * 1000)} ms writing, '
+            + f'pipe up to {self.pipe_queued_max} bytes ({self.pipe_full} times full), '
+            + f'{key_pool.wraps} keys wrapped by GnuPG (slowest {round(key_pool.wrap_seconds_max * 1000)} ms), '
+            + f'{key_pool.waits} waits for a key ({round(key_pool.wait_seconds * 1000)} ms)')
+        self.reset()
+
+
+class ActivityMeter:
+    """
+    Turns the scene change scores that ffmpeg prints for every frame (how much it differs from the frame before, 0 to 1)
+    into one activity score per activity_interval: the highest one, so that someone walking by stands out even if the
+    rest of the interval was still. Written into the recording as a metadata packet, see EncroCrypt.encrypt_metadata().
+    """
+
+    def __init__(self):
+        self.new_ffmpeg()
+        self.reset()
+
+
+    def new_ffmpeg(self):
+        self.partial = b''
+
+
+    def reset(self):
+        self.started = time.time()
+        self.score = 0
+        self.frames = 0
+
+
+    def feed(self, data):
+        # ffmpeg's metadata filter output: a frame:... line followed by key=value lines for each frame
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            key, _, value = line.partition(b'=')
+            if key != b'lavfi.scene_score':
+                continue
+            try:
+                self.score = max(self.score, float(value))
+            except ValueError:
+                continue
+            self.frames += 1
 
+
+    def due(self):
+        return time.time() >= self.started + Config.activity_interval
+
+
+    def take(self):
+        # Returns the metadata for the interval so far and starts the next one
+        metadata = {'start': round(self.started, 3), 'seconds': round(time.time() - self.started, 3), 'activity': round(self.score, 6), 'frames': self.frames}
+        self.reset()
+        return metadata
+
+
+def pipeQueued(pipe):
+    # How many bytes ffmpeg wrote that we did not read yet
+    queued = array.array('i', [0])
+    fcntl.ioctl(pipe.fileno(), termios.FIONREAD, queued)
+    return queued[0]
+
+
+def startFfmpeg(seconds, stderr):
+    # seconds=None means run until it is killed or the camera goes away. Returns the process, a pipe that ffmpeg writes
+    # its progress to (frame counts, see CaptureStats), and one that it writes the scene change scores to (see
+    # ActivityMeter; None if activity_interval is 0)
+    progress_read, progress_write = os.pipe()
+    pass_fds = [progress_write]
+    videofilter = r"drawtext = text = '%{localtime\:%Y/%m/%d %H\\\:%M\\\:%S}:box=1'"
+    if Config.activity_interval > 0:
+        # select computes the scene score for every frame (the expression is always true, so no frames are dropped) and
+        # metadata prints it to the pipe. Before drawtext, so the clock's seconds ticking by don't count as activity.
+        activity_read, activity_write = os.pipe()
+        pass_fds.append(activity_write)
+        videofilter = rf"select='gte(scene\,0)',metadata=mode=print:key=lavfi.scene_score:file=pipe\\:{activity_write}," + videofilter
     proc = subprocess.Popen([
         'ffmpeg',
+            '-progress', f'pipe:{progress_write}',
             '-f', Config.input_format,
             '-framerate', str(Config.input_framerate),
             '-video_size', Config.input_resolution,
             '-i', Config.input_device,
-            '-vf', r"drawtext = text = '%{localtime\:%Y/%m/%d %H\\\:%M\\\:%S}:box=1'",
+            '-vf', videofilter,
             '-codec', 'h264',  # Hardware-accelerated; also tested AV1, Theora, FFV1, VP9, and VP8 but they were either too slow, had a larger output, or lower quality output
             '-preset', Config.output_compression,
             '-f', Config.output_format,
             '-force_key_frames', f'expr:gte(t,n_forced*{Config.output_keyframetime})',
             '-x264-params', 'rc_lookahead=1:sync_lookahead=1',  # two of the options from -tune=zerolatency
-            '-t', str(remainingSeconds),
+        ] + (['-t', str(seconds)] if seconds is not None else []) + [
             'pipe:1'  # output to stdout
-        ], stdout=subprocess.PIPE, stderr=stderr)
+        ], stdout=subprocess.PIPE, stderr=stderr, bufsize=0, pass_fds=pass_fds)  # unbuffered: proc.stdout.readinto() returns what the pipe has instead of waiting to fill our buffer
+    os.close(progress_write)
+    if Config.activity_interval <= 0:
+        return proc, os.fdopen(progress_read, 'rb', buffering=0), None
+    os.close(activity_write)
+    return proc, os.fdopen(progress_read, 'rb', buffering=0), os.fdopen(activity_read, 'rb', buffering=0)
+
+
+def encryptAndWrite(ec, out, data, full):
+    out.seconds = 0
+    key_waits = key_pool.waits
+    packets = ec.packets_encrypted
+    start = time.perf_counter()
+    ec.encrypt_into(data, out)
+    seconds = time.perf_counter() - start
+    queued = pipeQueued(proc.stdout)
+    stats.flushed(len(data), full, seconds, out.seconds, queued)
+
+    captured_bytes.inc(len(data))
+    encrypted_packets.inc(ec.packets_encrypted - packets)
+    encrypt_seconds.observe(seconds - out.seconds)
+    write_seconds.observe(out.seconds)
+    pipe_queued.set(queued)
+    if key_pool.waits > key_waits:
+        key_waits_total.inc()
+        # A key was needed before the pool had one ready: this is what the pool should prevent, so say how bad it was
+        tprint(f'Waited for GnuPG to wrap a key; encrypting took {round(seconds * 1000)} ms and ffmpeg\'s pipe has {queued} bytes queued' + (' (full)' if queued >= pipe_size else ''))
+
+
+def writeActivity(ec, out):
+    metadata = activity_meter.take()
+    ec.encrypt_metadata(metadata, out)
+    activity_score.set(metadata['activity'])
+
+
+# Sleep until ffmpeg writes something (instead of polling), and encrypt+write once the buffer is full or the oldest data
+# in it has waited encrypt_interval seconds, whichever comes first. The buffer is allocated once and read into, so if
+# encrypting falls behind, we stop reading and ffmpeg blocks on the full pipe rather than our memory growing.
+buf = bytearray(Config.encrypt_max_bytes)
+view = memoryview(buf)
+filled = 0
+oldest = None  # time when the first byte currently in buf was read
+
+# Totals since record.py started, written to metrics_dir for monitoring (CaptureStats logs the same things per interval)
+registry = metrics.Registry(process_name)
+captured_bytes = registry.counter('encrocam_captured_bytes_total', 'Bytes of video read from ffmpeg and encrypted')
+encrypted_packets = registry.counter('encrocam_encrypted_packets_total', 'Encrypted data packets written')
+encrypt_seconds = registry.histogram('encrocam_encrypt_seconds', 'Time to encrypt one batch of captured data, not counting writing it')
+write_seconds = registry.histogram('encrocam_write_seconds', 'Time to write one batch of encrypted data to the file')
+keywrap_seconds = registry.histogram('encrocam_keywrap_seconds', 'Time GnuPG took to sign and encrypt a new key')
+key_waits_total = registry.counter('encrocam_key_waits_total', 'Times encrypting had to wait for GnuPG to wrap a key')
+frames_encoded = registry.counter('encrocam_frames_total', 'Frames encoded by ffmpeg')
+frames_dropped = registry.counter('encrocam_frames_dropped_total', 'Frames dropped by ffmpeg')
+ffmpeg_starts = registry.counter('encrocam_ffmpeg_starts_total', 'Times ffmpeg was started')
+ffmpeg_stalls = registry.counter('encrocam_ffmpeg_stalls_total', 'Times ffmpeg was killed for not writing any video for ffmpeg_stall_keyframes keyframe intervals')
+pipe_queued = registry.gauge('encrocam_pipe_queued_bytes', 'Bytes waiting in ffmpeg\'s output pipe after the last encrypt+write')
+activity_score = registry.gauge('encrocam_activity_score', 'Activity score of the last activity_interval: the largest scene change score between frames, 0 to 1')
+if Config.metrics_dir != False:
+    registry.start_writing(Config.metrics_dir, Config.metrics_interval)
+
+# Wrapped keys are prepared in the background (for the first file, too, while ffmpeg starts up), so starting a new file
+# or key does not make the capture loop wait for GnuPG
+key_pool = KeyPool(signing_fingerprint, encrypt_fingerprint, gnupghome, Config.key_pool_size, on_wrap=keywrap_seconds.observe)
+stats = CaptureStats()
+activity_meter = ActivityMeter()
+
+proc = None
+starttime = None
+remainingSeconds = None
+while True:
+    # Need to reinstantiate because the output file may have changed and this ensures it writes a key packet before any data packets
+    ec = EncroCrypt(signing_fingerprint, encrypt_fingerprint, gnupghome, key_pool=key_pool)
 
-    # Set proc.stdout to non-blocking, meaning that .read() will just grab whatever is in the pipe and we can periodically (time-based) encrypt+write rather than waiting for more data
-    fcntl.fcntl(proc.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
+    # To align the files to their supposed start time, compute the remaining time for this time slot
+    filestart = time.time()
+    seconds_per_file = Config.hours_per_recording * 3600
+    fileRemainingSeconds = seconds_per_file - (filestart % seconds_per_file)
+    filename = recordingFilename(filestart)
 
+    if proc is None:
+        stderr = subprocess.DEVNULL
+        oddly_short_threshold = 31  # seonds
+        if starttime is not None and time.time() - oddly_short_threshold < starttime and remainingSeconds is not None and remainingSeconds > oddly_short_threshold:
+            # ffmpeg ran for very little time, but was supposed to run for more than that? Let's see what's happening
+            stderr = None  # causes it to be printed
+
+        starttime = filestart
+        remainingSeconds = fileRemainingSeconds
+        # With gapless_rotation, ffmpeg keeps running across files and we cut its output into files ourselves
+        proc, progress, activity = startFfmpeg(None if Config.gapless_rotation else remainingSeconds, stderr)
+        stats.new_ffmpeg()
+        activity_meter.new_ffmpeg()
+        ffmpeg_starts.inc()
+        selector = selectors.DefaultSelector()
+        selector.register(proc.stdout, selectors.EVENT_READ)
+        selector.register(progress, selectors.EVENT_READ)
+        if activity is not None:
+            selector.register(activity, selectors.EVENT_READ)
+        pipe_size = fcntl.fcntl(proc.stdout.fileno(), fcntl.F_GETPIPE_SZ)
+        eof = False
+        killed = False
+        last_output = time.time()  # for the stall watchdog; starting up counts as output so the camera gets the full time to open
+
+    tprint(f'Starting recording for {round(fileRemainingSeconds/3600, 3)} hours to {filename}')
+
+    segments = SegmentFinder()
+    cut = None  # where in buf the next file starts, once we found it (gapless_rotation only)
     with open(filename, 'ab') as outfile:  # Append in case the file already exists. Wouldn't want to overwrite the recording after evil haxxor replugs the pi...
-        buf = b''
+        out = TimedWriter(outfile)
         while True:
-            tmp = None
-            try:
-                tmp = proc.stdout.read()  # Raises exception instead of blocking
-            except IOError:  # No data currently in the pipe
-                pass
+            if not eof:
+                timeout = 1  # wake up now and then regardless, to check on ffmpeg and report stats
+                if oldest is not None:
+                    timeout = max(0, oldest + Config.encrypt_interval - time.time())
+                if activity is not None:
+                    timeout = max(0, min(timeout, activity_meter.started + Config.activity_interval - time.time()))
+                for key, _ in selector.select(timeout):
+                    if key.fileobj is progress:
+                        data = progress.read(4096)
+                        if len(data) == 0:
+                            selector.unregister(progress)
+                        stats.progress(data)
+                        continue
+                    if key.fileobj is activity:
+                        data = activity.read(4096)
+                        if len(data) == 0:
+                            selector.unregister(activity)
+                        activity_meter.feed(data)
+                        continue
 
-            if tmp is not None:
-                buf += tmp
+                    if filled == len(buf):
+                        # Only after a cut: the rest of the previous file's last read filled the buffer. Reading into
+                        # no space would return 0 and look like EOF, so encrypt that first (below) and read after.
+                        continue
+                    n = proc.stdout.readinto(view[filled : ])
+                    if n == 0:  # ffmpeg closed its stdout (it indeed should exit after -t seconds)
+                        eof = True
+                    else:
+                        if oldest is None:
+                            oldest = time.time()
+                        last_output = time.time()
+                        if Config.gapless_rotation and time.time() >= filestart + fileRemainingSeconds:
+                            cut = segments.find(buf, filled, filled + n)
+                        filled += n
 
-            if len(buf) > 0:
-                outfile.write(ec.encrypt(buf))
-                buf = b''
+            if Config.gapless_rotation and cut is None and time.time() >= filestart + fileRemainingSeconds + Config.output_keyframetime * 3 and last_output >= filestart + fileRemainingSeconds:
+                # No segment start showed up even though ffmpeg is writing (is output_format not hls?), so cut wherever we
+                # are. If ffmpeg is not writing at all, it hangs: that's for the stall watchdog below, rather than rotating
+                # to a new file that stays empty.
+                cut = filled
 
-            if time.time() - starttime > Config.hours_per_recording * 3600 * 1.02:
-                # ffmpeg process is running for 2% longer than it should have (e.g. 18 seconds on 3 hours).
-                # Don't bother trying to terminate (SIGINT) first, output should be streamable anyhow and this
-                # way we can just start a new ffmpeg and get on with a hopefully functional recording
-                proc.kill()  
+            if cut is not None:
+                if cut > 0:
+                    encryptAndWrite(ec, out, view[ : cut], False)
+                if activity is not None and activity_meter.frames > 0:
+                    writeActivity(ec, out)  # the interval so far belongs to this file, not to the next one's first packet
                 break
 
-            elif proc.poll() is not None:  # process has exited (it indeed should after -t seconds)
+            if filled > 0 and (filled == len(buf) or eof or time.time() >= oldest + Config.encrypt_interval):
+                encryptAndWrite(ec, out, view[ : filled], filled == len(buf))
+                filled = 0
+                oldest = None
+
+            if activity is not None and (activity_meter.due() or (eof and activity_meter.frames > 0)):
+                writeActivity(ec, out)
+
+            stats.report_if_due()
+
+            if eof:
+                proc.wait()
+                selector.close()
+                progress.close()
+                if activity is not None:
+                    activity.close()
+                proc = None
                 break
 
-            time.sleep(Config.encrypt_interval)
+            if not killed and not Config.gapless_rotation and time.time() - starttime > Config.hours_per_recording * 3600 * 1.02:
+                # ffmpeg process is running for 2% longer than it should have (e.g. 18 seconds on 3 hours).
+                # Don't bother trying to terminate (SIGINT) first, output should be streamable anyhow and this
+                # way we can just start a new ffmpeg and get on with a hopefully functional recording. We keep
+                # reading until the pipe is closed so that whatever ffmpeg wrote before that is still saved.
+                proc.kill()
+                killed = True
+
+            if not killed and Config.ffmpeg_stall_keyframes > 0 and time.time() - last_output > Config.ffmpeg_stall_keyframes * Config.output_keyframetime:
+                # ffmpeg writes a segment at least every output_keyframetime, so this long without any output means it
+                # hangs, e.g. on a camera that stopped sending frames without an error. Without gapless_rotation the check
+                # above would eventually catch that too, but only at the end of the file. Kill it the same way: once the
+                # pipe closes, the eof handling starts a new ffmpeg (and file, if the time slot is over).
+                tprint(f'ffmpeg wrote no video for {round(time.time() - last_output)} seconds, restarting it')
+                ffmpeg_stalls.inc()
+                proc.kill()
+                killed = True
+
+    if cut is not None:
+        # The rest of the buffer is the start of the next file
+        rest = bytes(view[cut : filled])
+        buf[ : len(rest)] = rest
+        filled = len(rest)
+        if filled == 0:
+            oldest = None
 
+    stats.report_if_due(force=True)
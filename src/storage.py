@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# Storage backends for sync.py: where the encrypted recordings are uploaded to
+
+# Stdlib
+import os, time, ftplib, ssl
+# Optional third-party dependencies
+try:
+    import boto3, botocore.exceptions
+except ImportError:
+    boto3 = None
+
+# The exceptions that storage backends raise when the storage is unreachable or misbehaves
+errors = (*ftplib.all_errors, ssl.SSLError)  # ftplib.all_errors includes OSError
+if boto3 is not None:
+    errors += (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)
+
+
+class StorageBackend:
+    """
+    What sync.py needs from the place where recordings are stored. Files are identified by name; there are no
+    subdirectories. Implementations raise one of the exception types in storage.errors when the storage is unreachable
+    or misbehaves, after which sync.py will make a new backend object (reconnect) and list the files again.
+    """
+
+    def list(self):
+        """
+        backend_obj.list() -> dict
+        Returns {filename: size in bytes} of the stored files.
+        """
+        raise NotImplementedError
+
+
+    def size(self, fname):
+        """
+        backend_obj.size(string) -> int or None
+        Returns the size of the stored file, or None if there is no such file.
+        """
+        return self.list().get(fname)
+
+
+    def delete(self, fname):
+        raise NotImplementedError
+
+
+    def append(self, fname, offset):
+        """
+        backend_obj.append(string, int) -> stream object
+        Opens a stream that appends to the stored file (creating it if offset is 0), which has `offset` bytes currently.
+        The stream has write(bytes) and close() methods, which both return how many bytes of the file the storage has
+        by then. Data may be buffered until close(), so that can be less than was written.
+        """
+        raise NotImplementedError
+
+
+    def close(self):
+        pass
+
+
+class FTPSBackend(StorageBackend):
+    """
+    Any FTP server with TLS. Appending uses the FTP APPE command: everything written to the stream goes over one data
+    connection, which the server appends to the file as it comes in.
+    """
+
+    def __init__(self, host, user, password, directory, timeout):
+        context = ssl.create_default_context()
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = True  # Seems to be implicit for CERT_REQUIRED but...
+        context.minimum_version = ssl.TLSVersion.TLSv1_3
+
+        self.ftps = ftplib.FTP_TLS(host, context=context, timeout=timeout)
+        self.ftps.login(user, password)
+        self.ftps.prot_p()  # Require data connection to be secure (not just control connection)
+
+        self.ftps.cwd(directory)
+
+
+    def list(self):
+        sizes = {}
+        for fname, attributes in self.ftps.mlsd():
+            if attributes['type'] == 'file':
+                sizes[fname] = int(attributes['size'])
+        return sizes
+
+
+    def delete(self, fname):
+        self.ftps.delete(fname)
+
+
+    def append(self, fname, offset):
+        cmd = 'APPE' if offset > 0 else 'STOR'  # append or upload new file
+        self.ftps.voidcmd('TYPE I')  # binary mode, as storbinary would do (listing the directory switches to TYPE A)
+        return FTPSBackend.Stream(self.ftps, self.ftps.transfercmd(f'{cmd} {fname}'), offset)
+
+
+    def close(self):
+        try:
+            self.ftps.close()
+        except Exception:
+            pass
+
+
+    class Stream:
+        def __init__(self, ftps, conn, size):
+            self.ftps = ftps
+            self.conn = conn
+            self.size = size
+
+
+        def write(self, data):
+            self.conn.sendall(data)
+            self.size += len(data)
+            return self.size
+
+
+        def close(self):
+            # Same as ftplib's storbinary does when it's done
+            if isinstance(self.conn, ssl.SSLSocket):
+                self.conn.unwrap()
+            self.conn.close()
+            self.ftps.voidresp()
+            return self.size
+
+
+class S3Backend(StorageBackend):
+    """
+    S3 or S3-compatible object storage, using boto3 (only needed if you use this backend). Objects can't be appended
+    to on most S3 implementations, so an append rewrites the object: small objects are downloaded and uploaded again
+    with the new data, larger ones are extended server-side with a multipart upload that copies the existing object as
+    its first part(s), in ranges of at most 5 GiB. To keep the number of rewrites down, the stream buffers data until
+    it has `part_size` bytes (and on close()), which means the remote copy lags behind by up to that much.
+    """
+
+    MIN_PART_SIZE = 5 * 1024 * 1024  # S3 requires all but the last part of a multipart upload to be at least this big
+    MAX_COPY_PART_SIZE = 5 * 1024 * 1024 * 1024  # and refuses to copy more than this into one part
+
+    def __init__(self, endpoint_url, bucket, access_key, secret_key, prefix='', part_size=8 * 1024 * 1024):
+        if boto3 is None:
+            raise Exception('The S3 storage backend needs boto3: sudo apt install python3-boto3')
+
+        self.s3 = boto3.client('s3', endpoint_url=endpoint_url or None, aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, S3Backend.MIN_PART_SIZE)
+
+
+    def list(self):
+        sizes = {}
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                fname = obj['Key'][len(self.prefix) : ]
+                if '/' not in fname:
+                    sizes[fname] = obj['Size']
+        return sizes
+
+
+    def delete(self, fname):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.prefix + fname)
+
+
+    def append(self, fname, offset):
+        return S3Backend.Stream(self, self.prefix + fname, offset)
+
+
+    def _append(self, key, size, data):
+        # Appends data to the object (which has `size` bytes) and returns its new size
+        if size == 0:
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=data)
+        elif size < S3Backend.MIN_PART_SIZE:
+            existing = self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=existing + data)
+        else:
+            # A single copied part can't be bigger than MAX_COPY_PART_SIZE, so split the existing data into equal ranges
+            # (rather than full ranges and a remainder, which could end up below MIN_PART_SIZE)
+            count = -(-size // S3Backend.MAX_COPY_PART_SIZE)
+            range_size = -(-size // count)
+            upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+            try:
+                parts = []
+                for start in range(0, size, range_size):
+                    end = min(start + range_size, size) - 1  # inclusive
+                    copied = self.s3.upload_part_copy(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=len(parts) + 1,
+                        CopySource={'Bucket': self.bucket, 'Key': key}, CopySourceRange=f'bytes={start}-{end}')
+                    parts.append({'PartNumber': len(parts) + 1, 'ETag': copied['CopyPartResult']['ETag']})
+                added = self.s3.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=len(parts) + 1, Body=data)
+                parts.append({'PartNumber': len(parts) + 1, 'ETag': added['ETag']})
+                self.s3.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+            except:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+                raise
+        return size + len(data)
+
+
+    class Stream:
+        def __init__(self, backend, key, size):
+            self.backend = backend
+            self.key = key
+            self.size = size
+            self.buffer = bytearray()
+
+
+        def write(self, data):
+            self.buffer += data
+            if len(self.buffer) >= self.backend.part_size:
+                return self.flush()
+            return self.size  # the buffered data isn't stored yet
+
+
+        def flush(self):
+            if len(self.buffer) > 0:
+                self.size = self.backend._append(self.key, self.size, bytes(self.buffer))
+                self.buffer = bytearray()
+            return self.size
+
+
+        def close(self):
+            return self.flush()
+
+
+class LocalBackend(StorageBackend):
+    """
+    A directory on this machine, such as a mounted network drive. Also useful for testing and benchmarking without a
+    server. With `latency` set, every operation waits that many seconds first, to imitate a remote server.
+    """
+
+    def __init__(self, directory, latency=0):
+        self.directory = directory
+        self.latency = latency
+
+
+    def list(self):
+        time.sleep(self.latency)
+        return {fname: os.path.getsize(f'{self.directory}/{fname}') for fname in os.listdir(self.directory) if os.path.isfile(f'{self.directory}/{fname}')}
+
+
+    def delete(self, fname):
+        time.sleep(self.latency)
+        os.remove(f'{self.directory}/{fname}')
+
+
+    def append(self, fname, offset):
+        time.sleep(self.latency)
+        fp = open(f'{self.directory}/{fname}', 'ab' if offset > 0 else 'wb', buffering=0)  # unbuffered: visible right away, like an upload
+        if fp.tell() != offset:
+            size = fp.tell()
+            fp.close()
+            raise OSError(f'{fname} has {size} bytes in storage, expected {offset}')
+        return LocalBackend.Stream(fp)
+
+
+    class Stream:
+        def __init__(self, fp):
+            self.fp = fp
+
+
+        def write(self, data):
+            self.fp.write(data)
+            return self.fp.tell()
+
+
+        def close(self):
+            size = self.fp.tell()
+            self.fp.close()
+            return size
+
+
+class Uploader:
+    """
+    Uploads what was added to local files since the last upload. How far each file was uploaded is tracked locally,
+    so the storage only needs to be listed again after an error (when we reconnect). New data for the same file is
+    sent over one long-lived append stream (for FTPS: one data connection), rather than starting a new upload every time.
+    """
+
+    def __init__(self, connect, local_dir, blocksize=64 * 1024, bandwidth_limit=0, stopping=None):
+        """
+        uploader_obj = Uploader(function, string, int, int, threading.Event or None)
+        connect is called without arguments to get a (new) StorageBackend object.
+        bandwidth_limit is in bytes per second (0 means unlimited). Uploads return early once `stopping` is set.
+        """
+        self.connect_backend = connect
+        self.local_dir = local_dir
+        self.blocksize = blocksize
+        self.backend = None
+        self.stream = None  # (filename, append stream, local file object) of the open upload stream
+        self.remote_sizes = {}  # filename -> bytes of the file that the storage has
+        self.bandwidth_limit = bandwidth_limit
+        self.stopping = stopping
+        self.connections_opened = 0
+        self.bytes_uploaded = 0
+        self.connect()
+
+
+    def connect(self):
+        self.backend = self.connect_backend()
+        self.remote_sizes = self.backend.list()
+
+
+    def reconnect(self):
+        # After an error, we can't be sure what the storage has: start over and ask
+        if self.stream is not None:
+            self.stream[2].close()
+            self.stream = None
+        if self.backend is not None:
+            self.backend.close()
+        self.connect()
+
+
+    def openStream(self, fname):
+        fp = open(f'{self.local_dir}/{fname}', 'rb')
+        fp.seek(self.remote_sizes.get(fname, 0))
+        self.stream = (fname, self.backend.append(fname, self.remote_sizes.get(fname, 0)), fp)
+        self.remote_sizes[fname] = self.remote_sizes.get(fname, 0)
+        self.connections_opened += 1
+
+
+    def closeStream(self):
+        if self.stream is None:
+            return
+        fname, stream, fp = self.stream
+        self.stream = None
+        fp.close()
+        self.stored(fname, stream.close())
+
+
+    def stored(self, fname, size):
+        # The stream says the storage has `size` bytes of the file now
+        self.bytes_uploaded += size - self.remote_sizes[fname]
+        self.remote_sizes[fname] = size
+
+
+    def upload(self, fname, finished=False):
+        """
+        uploader_obj.upload(string, bool)
+        Sends whatever the local file has beyond what was uploaded before. Set `finished` when the file won't be written
+        to anymore, so the upload stream gets closed. After an error, call reconnect() before uploading again.
+        """
+        size = os.path.getsize(f'{self.local_dir}/{fname}')
+        if size > self.remote_sizes.get(fname, 0):
+            if self.stream is None or self.stream[0] != fname:
+                self.closeStream()
+                self.openStream(fname)
+
+            _, stream, fp = self.stream
+            started = time.time()
+            sent = 0
+            while fp.tell() < size:  # what we sent, while remote_sizes is what the storage has (less if the stream buffers)
+                if self.stopping is not None and self.stopping.is_set():
+                    return
+
+                buf = fp.read(min(self.blocksize, size - fp.tell()))
+                if len(buf) == 0:
+                    break
+                self.stored(fname, stream.write(buf))
+                sent += len(buf)
+
+                if self.bandwidth_limit > 0:
+                    ahead = sent / self.bandwidth_limit - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        if finished and self.stream is not None and self.stream[0] == fname:
+            self.closeStream()
+
+
+    def delete(self, fname):
+        self.backend.delete(fname)
+        self.remote_sizes.pop(fname, None)
+
+
+    def close(self):
+        self.closeStream()
+        self.backend.close()
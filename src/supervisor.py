@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Runs record.py once per camera in Config.cameras, or once for the single camera of the input_ settings if that list is
+# empty, and restarts each of them when it exits without disturbing the others. All cameras record into the same
+# directory (with the camera name in the filename), so one sync.py uploads everything.
+
+import sys, os, re, time, signal, subprocess
+from logfile import setup_directories, make_tprint
+import metrics
+sys.path.append('../')
+from encrypted_mountpoint.config import *
+import configdefaults
+settings_defaulted = configdefaults.fill_in(Config)  # config.py may be older than some settings, those get their default value
+
+encrocam_homedir = sys.argv[1]
+signing_fingerprint = sys.argv[2]
+encrypt_fingerprint = sys.argv[3]
+recordings_directory = sys.argv[4]
+
+
+setup_directories(Config, encrocam_homedir)
+tprint = make_tprint(Config.logfile_dir, 'supervisor', 'Supervisor: ', urgent=True)  # rare, and mostly about problems
+
+
+class Worker:
+    """
+    One record.py process for one camera, optionally pinned to the CPU cores in the camera's 'cores' setting (ffmpeg,
+    which record.py starts, inherits that). If it keeps exiting within a minute of being started, the delay before
+    restarting it doubles, up to a minute, so a camera that was unplugged doesn't make us spin.
+    """
+
+    def __init__(self, camera):
+        self.camera = camera  # entry of Config.cameras, or None for the single-camera setup
+        self.name = camera['name'] if camera is not None else 'record.py'
+        self.proc = None
+        self.started = None
+        self.restarts = 0
+        self.backoff = 0
+        self.restart_at = 0
+
+
+    def start(self):
+        args = [sys.executable, os.path.dirname(os.path.abspath(__file__)) + '/record.py', encrocam_homedir, signing_fingerprint, encrypt_fingerprint, recordings_directory]
+        cores = None
+        if self.camera is not None:
+            args.append(self.camera['name'])
+            cores = self.camera.get('cores')
+        self.proc = subprocess.Popen(args, preexec_fn=(lambda: os.sched_setaffinity(0, cores)) if cores else None)
+        self.started = time.time()
+
+
+    def check(self):
+        # Restarts the worker if it exited (and its delay passed)
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                return
+
+            ran = time.time() - self.started
+            self.backoff = 0 if ran > 60 else min(max(1, self.backoff * 2), 60)
+            self.restart_at = time.time() + self.backoff
+            self.restarts += 1
+            tprint(f'{self.name} exited with status {self.proc.returncode} after {round(ran)} seconds, restarting in {self.backoff} seconds ({self.restarts} restarts so far)')
+            self.proc = None
+
+        if time.time() >= self.restart_at:
+            self.start()
+
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+if len(Config.cameras) == 0:
+    workers = [Worker(None)]
+else:
+    names = [camera['name'] for camera in Config.cameras]
+    for name in names:
+        # The name goes into the filename, which filenameToTime() must still be able to parse
+        if not re.fullmatch('[A-Za-z0-9_]+', name) or names.count(name) > 1:
+            print(f'Invalid camera name {repr(name)} in the cameras setting: must be unique and consist of letters, digits, and underscores')
+            exit(1)
+    workers = [Worker(camera) for camera in Config.cameras]
+
+
+def stop(signum, frame):
+    for worker in workers:
+        worker.stop()
+    exit(0)
+
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+
+if Config.metrics_port and Config.metrics_dir != False:
+    # The recording processes (and sync.py) write their metrics to files; serve them all from one place
+    metrics.serve_directory(Config.metrics_dir, Config.metrics_port, max_age=Config.metrics_interval * 4)
+    tprint(f'Serving metrics on http://127.0.0.1:{Config.metrics_port}/metrics')
+
+if len(settings_defaulted) > 0:
+    tprint(f'Using the default value for settings missing from config.py: {", ".join(settings_defaulted)}')
+tprint(f'Starting {len(workers)} recording process(es)')
+while True:
+    for worker in workers:
+        worker.check()
+    time.sleep(1)
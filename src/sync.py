@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 
 # Stdlib
-import sys, os, time, ftplib, ssl
+import sys, os, time, threading, signal
 # Third-party dependencies
 import pyinotify, requests
 # Local imports
+import storage, metrics
+from logfile import setup_directories, make_tprint
 sys.path.append('../')
 from encrypted_mountpoint.config import *
+import configdefaults
+settings_defaulted = configdefaults.fill_in(Config)  # config.py may be older than some settings, those get their default value
+
+def isRecording(filename):
+    # Recordings have the extension of timeToFilename()'s names. filenameToTime() would also parse other files that
+    # start with a recording's name, like the <recording>.index that decrypter.py keeps next to it
+    return os.path.splitext(filename)[1] == os.path.splitext(timeToFilename(0))[1]
+
 
 def shouldRemove(filename):
+    if not isRecording(filename):
+        return True if Config.remove_unrecognized_files else False
     try:
         t = filenameToTime(filename)
     except:
@@ -25,77 +37,370 @@ def shouldRemove(filename):
     return False
 
 
-def tprint(msg, printfunc=print):
-    msgwithtime = time.strftime('%a %d %b %H:%M:%S %z', time.localtime()) + ' ' + msg
-    printfunc(msgwithtime)
+def recordingTime(filename):
+    # Like filenameToTime(), but 0 for files it does not recognize (which are kept if remove_unrecognized_files is off)
+    try:
+        return filenameToTime(filename)
+    except:
+        return 0
+
+
+def cameraOf(filename):
+    # () for rec-<slot>.encrocam, ('front',) for rec-<slot>-front.encrocam
+    return tuple(os.path.splitext(filename)[0].split('-', 2)[2 : ])
 
-    if Config.logfile_dir != False:
-        fname = 'stdout' if printfunc == print else 'stderr'
-        with open(f'{Config.logfile_dir}/{time.strftime("%A")}-{fname}.log', 'at', encoding='UTF-8') as f:
-            f.write(msgwithtime + ('\n' if printfunc == print else ''))
 
+def connectStorage():
+    # Returns a new connection to the configured storage. The Uploader calls this again to reconnect after errors.
+    if Config.storage_backend == 's3':
+        return storage.S3Backend(Config.s3_endpoint_url, Config.s3_bucket, Config.s3_access_key, Config.s3_secret_key, Config.s3_prefix, Config.s3_part_size)
+    elif Config.storage_backend == 'local':
+        return storage.LocalBackend(Config.local_storage_dir)
+    else:
+        return storage.FTPSBackend(Config.ftp_host, Config.ftp_user, Config.ftp_pass, Config.ftp_dir, Config.ftp_timeout)
 
-def MLSD(ftps):
-    raw = ftps.mlsd()
-    dirlist_dict = {}
-    for f in raw:
-        # dirlist_dict[filename] = {attribute: value, ...}
-        dirlist_dict[f[0]] = f[1]
 
-    return dirlist_dict
+def storageConfigured():
+    if Config.storage_backend == 's3':
+        return Config.s3_bucket not in [None, '']
+    elif Config.storage_backend == 'local':
+        return Config.local_storage_dir not in [None, '']
+    else:
+        return Config.ftp_host not in [None, '']
+
+
+def closeUploader(uploader):
+    try:
+        uploader.close()
+    except storage.errors as e:
+        tprint(f'Closing the upload stream failed ({type(e).__name__}: {e})\n', sys.stderr.write)
+
+
+class Backfill:
+    """
+    Uploads past recordings that the server is missing or has incompletely, for example after an Internet outage.
+    Runs in the background on backfill_connections connections of its own, each limited to backfill_bandwidth_limit,
+    so that the current recording keeps being uploaded live on the main connection in the meantime. The most recent
+    recordings go first. Anything not done when sync.py restarts will be picked up again by the next run.
+    """
+
+    BUSY_SECONDS = 60  # files written to more recently than this are left to the live upload, see sync.py's startup
+
+    def __init__(self, files):
+        self.files = files  # [(filename, bytes to upload)], most recent last because we pop() from the end
+        self.names = set(fname for fname, missing in files)  # the live upload keeps its hands off these
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.uploaders = []
+        self.bytes_total = sum(missing for fname, missing in files)
+        self.started = time.time()
+        self.retries = 0
+
+
+    def start(self):
+        for i in range(min(Config.backfill_connections, len(self.files))):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    def run(self):
+        backoff = 0
+        uploader = None
+        while not self.stopping.is_set():
+            with self.lock:
+                if len(self.files) == 0:
+                    break
+                fname, missing = self.files.pop()
+
+            try:
+                if uploader is None:
+                    uploader = storage.Uploader(connectStorage, local_dir, Config.upload_blocksize, Config.backfill_bandwidth_limit, self.stopping)
+                    with self.lock:
+                        self.uploaders.append(uploader)
+                tprint(f'Backfill: uploading {missing} bytes of {fname}')
+                uploader.upload(fname, True)
+                backoff = 0
+            except storage.errors as e:
+                with self.lock:
+                    self.files.append((fname, missing))
+                uploader = None  # the connection is broken: make a new one rather than trying to close the upload
+                self.retries += 1
+                backoff = min(max(1, backoff * 2), Config.upload_retry_max_seconds)
+                tprint(f'Backfill of {fname} failed ({type(e).__name__}: {e}), retrying in {backoff} seconds\n', sys.stderr.write)
+                self.stopping.wait(backoff)
+
+        if uploader is not None:
+            closeUploader(uploader)
+
+
+    def done(self):
+        return not any(thread.is_alive() for thread in self.threads)
+
+
+    def owns(self, fname):
+        # Whether this file is ours to upload. Two Uploaders appending to one file would each go by their own idea of
+        # how much the storage has, and duplicate data in it
+        return fname in self.names
+
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(Config.ftp_timeout * 2)
+
+
+    def uploaded(self):
+        with self.lock:
+            return sum(uploader.bytes_uploaded for uploader in self.uploaders)
+
+
+    def progress(self):
+        uploaded = self.uploaded()
+        rate = uploaded / max(1, time.time() - self.started)
+        line = f'Backfill: {uploaded / 1e6:.1f} of {self.bytes_total / 1e6:.1f} MB, {rate / 1e6:.2f} MB/s'
+        if rate > 0 and not self.done():
+            line += f', ETA {round((self.bytes_total - uploaded) / rate / 60)} minutes'
+        return line
+
+
+class UploadQueue:
+    """
+    What the inotify handler hands to the upload worker: for each file, the size we last saw and whether it was closed.
+    Events for a file that is already queued update its entry, so the queue never holds more than one entry per file
+    no matter how far the uploads fall behind; the worker then simply uploads a larger piece at once.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}  # filename -> (size, closed)
+        self.pending_since = None
+
+
+    def put(self, fname, size, closed):
+        with self.condition:
+            old_size, old_closed = self.pending.get(fname, (0, False))
+            self.pending[fname] = (max(size, old_size), old_closed or closed)
+            if self.pending_since is None:
+                self.pending_since = time.time()
+            self.condition.notify()
+
+
+    def get(self, timeout):
+        """
+        queue_obj.get(float) -> dict
+        Waits until files have been queued for upload_coalesce_seconds, and returns and removes all of them. Returns an
+        empty dict if that did not happen within the timeout.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.pending_since is not None and now >= self.pending_since + Config.upload_coalesce_seconds:
+                    pending = self.pending
+                    self.pending = {}
+                    self.pending_since = None
+                    return pending
+
+                if now >= deadline:
+                    return {}
+
+                if self.pending_since is None:
+                    self.condition.wait(deadline - now)
+                else:
+                    self.condition.wait(min(deadline, self.pending_since + Config.upload_coalesce_seconds) - now)
+
+
+class UploadWorker(threading.Thread):
+    """
+    Uploads what the inotify handler queued, separately from the inotify event processing so that a slow or unreachable
+    server does not hold up reading events. Failed uploads are queued again and retried after a delay that doubles on
+    every consecutive failure, up to upload_retry_max_seconds.
+    Each camera gets an Uploader (connection and upload stream) of its own: the cameras' current recordings all grow
+    at the same time, and on a single stream every upload would have to close the other camera's stream and reopen
+    its own. The uploader that sync.py started with goes to the first camera, the others connect when they need to.
+    """
+
+    def __init__(self, uploader, upload_queue):
+        super().__init__(daemon=True)
+        self.spare = uploader  # not yet used for any camera
+        self.uploaders = {}  # cameraOf(filename) -> Uploader
+        self.remote_sizes = dict(uploader.remote_sizes)  # from the initial listing, for cameras without an uploader yet
+        self.upload_queue = upload_queue
+        self.stopping = threading.Event()
+        self.last_success = None
+        self.uploads_issued = 0
+        self.retries = 0
+
+
+    def uploaderFor(self, fname):
+        camera = cameraOf(fname)
+        if camera not in self.uploaders:
+            if self.spare is not None:
+                self.uploaders[camera] = self.spare
+                self.spare = None
+            else:
+                self.uploaders[camera] = storage.Uploader(connectStorage, local_dir, Config.upload_blocksize)
+        return self.uploaders[camera]
+
+
+    def allUploaders(self):
+        return list(self.uploaders.values()) + ([self.spare] if self.spare is not None else [])
+
+
+    def remoteSize(self, fname):
+        uploader = self.uploaders.get(cameraOf(fname))
+        return (uploader.remote_sizes if uploader is not None else self.remote_sizes).get(fname, 0)
+
+
+    def uploaded(self):
+        return sum(uploader.bytes_uploaded for uploader in self.allUploaders())
+
+
+    def connectionsOpened(self):
+        return sum(uploader.connections_opened for uploader in self.allUploaders())
+
+
+    def run(self):
+        backoff = 0
+        needs_reconnect = set()  # cameras whose upload failed
+        while not self.stopping.is_set():
+            pending = self.upload_queue.get(timeout=1)
+            if len(pending) == 0:
+                continue
+
+            fname = None
+            try:
+                while len(pending) > 0:
+                    fname, (size, closed) = next(iter(pending.items()))
+                    if os.path.exists(f'{local_dir}/{fname}') and not backfill.owns(fname):  # it may have been cleaned up in the meantime, or be the backfill's to upload
+                        camera = cameraOf(fname)
+                        if camera in needs_reconnect:
+                            needs_reconnect.discard(camera)  # added again if this fails too
+                            if camera in self.uploaders:  # else connecting failed, uploaderFor() tries again
+                                self.uploaders[camera].reconnect()
+                        uploader = self.uploaderFor(fname)
+                        start = time.perf_counter()
+                        uploader.upload(fname, closed)
+                        upload_seconds.observe(time.perf_counter() - start)
+                        self.uploads_issued += 1
+                    del pending[fname]
+
+                backoff = 0
+                self.last_success = time.time()
+
+            except storage.errors as e:
+                for fname_left, (size, closed) in pending.items():
+                    self.upload_queue.put(fname_left, size, closed)
+                needs_reconnect.add(cameraOf(fname))
+                self.retries += 1
+                backoff = min(max(1, backoff * 2), Config.upload_retry_max_seconds)
+                tprint(f'Upload of {fname} failed ({type(e).__name__}: {e}), retrying in {backoff} seconds\n', sys.stderr.write)
+                self.stopping.wait(backoff)
+
+        for camera, uploader in self.uploaders.items():
+            if camera not in needs_reconnect:
+                closeUploader(uploader)
+        if self.spare is not None:
+            closeUploader(self.spare)
+
+
+class Heartbeat(threading.Thread):
+    """
+    Calls the monitoring URL every monitoring_interval seconds, on its own thread so that a hanging monitoring service
+    doesn't delay uploads. It only calls while there is progress: `alive` returns when the last upload succeeded (or
+    when a file was last written, if uploading is disabled). If recording or uploading stops, we stop checking in.
+    """
+
+    def __init__(self, alive):
+        super().__init__(daemon=True)
+        self.alive = alive
+
+
+    def run(self):
+        last_monitoring = -1
+        while True:
+            last_alive = self.alive()
+            if last_alive is not None and last_alive > last_monitoring and last_monitoring + Config.monitoring_interval < time.time():
+                try:
+                    requests.get(Config.monitoring_url, timeout=3)
+                    last_monitoring = time.time()
+                    tprint('Sync: ' + stats())
+                except requests.RequestException as e:
+                    tprint(f'Calling the monitoring URL failed ({type(e).__name__}: {e})\n', sys.stderr.write)
+            time.sleep(1)
 
 
 class NotifyHandler(pyinotify.ProcessEvent):
+    def my_init(self):
+        self.events_received = 0
+        self.last_event = None
+
+
     def process_IN_MODIFY(self, event):
-        return self.doStuff(event)
+        return self.doStuff(event, False)
 
 
     def process_IN_CLOSE_WRITE(self, event):
-        return self.doStuff(event)
+        return self.doStuff(event, True)
 
 
-    def doStuff(self, event):
-        global last_monitoring, remote_dirlist  # we'll update these after appending to a file
+    def doStuff(self, event, closed):
+        # Only take note of the event, the upload worker does the uploading
+        self.events_received += 1
+        inotify_events.inc()
 
+        if not isRecording(event.name):
+            return  # e.g. decrypter.py writing an index file; not something to upload
         if shouldRemove(event.name):  # in case garbage is showing up, let's not blindly upload that
             tprint(f'Warning: garbage file "{event.name}" being written to in the local directory. Refusing to upload.\n', sys.stderr.write)
             return
 
+        self.last_event = time.time()
         if not disable_uploading:
-            with open(f'{local_dir}/{event.name}', 'rb') as fp:
-                cmd = 'STOR'  # upload new file
-                if event.name in remote_dirlist:
-                    fp.seek(int(remote_dirlist[event.name]['size']))
-                    cmd = 'APPE'  # append
+            try:
+                upload_queue.put(event.name, os.path.getsize(f'{local_dir}/{event.name}'), closed)
+            except FileNotFoundError:
+                pass
 
-                ftps.storbinary(f'{cmd} {event.name}', fp)
-                remote_dirlist = MLSD(ftps)
 
-        if Config.monitoring_url.strip() not in [None, ''] and last_monitoring + Config.monitoring_interval < time.time():
-            requests.get(Config.monitoring_url, timeout=3)
-            last_monitoring = time.time()
+def uploadLag():
+    # Bytes of the current recording(s) that are on disk but not yet on the server: how far the live upload is behind
+    lag = 0
+    current = filenameToTime(timeToFilename(time.time()))
+    for fname in os.listdir(local_dir):
+        if isRecording(fname) and recordingTime(fname) == current:
+            try:
+                lag += max(0, os.path.getsize(f'{local_dir}/{fname}') - worker.remoteSize(fname))
+            except FileNotFoundError:
+                pass
+    return lag
 
-        if time.time() > starttime + sync_restart_after_seconds:
-            tprint('Sync: time up, restarting')
-            sys.exit(0)
+
+def stats():
+    line = f'{handler.events_received} inotify events'
+    if not disable_uploading:
+        line += f', {worker.uploads_issued} uploads, {worker.retries} retries, {worker.connectionsOpened()} data connections, {worker.uploaded()} bytes uploaded'
+    return line
 
 
 encrocam_homedir = sys.argv[1]
-if '__encrocam_homedir__' in Config.logfile_dir:
-    Config.logfile_dir = Config.logfile_dir.replace('__encrocam_homedir__', encrocam_homedir)
-if Config.logfile_dir != False and not os.path.isdir(Config.logfile_dir):
-    try:
-        os.mkdir(Config.logfile_dir)
-        tprint('Created log directory')
-    except:
-        Config.logfile_dir = False
-        tprint('Failed to create log directory:', Config.logfile_dir)
+setup_directories(Config, encrocam_homedir)
+tprint = make_tprint(Config.logfile_dir, 'sync')
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))  # exit normally when stopped (with the usual status), so the log file gets flushed
+
+registry = metrics.Registry('sync')
+inotify_events = registry.counter('encrocam_inotify_events_total', 'File write events received from inotify')
+upload_seconds = registry.histogram('encrocam_upload_seconds', 'Time to upload the new data of one file (live upload only)')
 
 starttime = time.time()
-last_monitoring = -1
 local_dir = sys.argv[2]
 sync_restart_after_seconds = int(sys.argv[3]) * 60
 
+if len(settings_defaulted) > 0:
+    tprint(f'Using the default value for settings missing from config.py: {", ".join(settings_defaulted)}')
+
 tprint('Checking for local garbage')
 local_dirlist = os.listdir(local_dir)  # will not contain . and .. according to python docs
 for f in local_dirlist:
@@ -106,51 +411,82 @@ for f in local_dirlist:
 local_dirlist = os.listdir(local_dir)  # refresh after potentially having deleted files (we use it later)
 
 disable_uploading = False
-if ftp_host is None or len(ftp_host) == 0:
+if not storageConfigured():
     disable_uploading = True
-    tprint('Skipped remote operations because ftp_host is empty or None')
+    tprint(f'Skipped remote operations because the {Config.storage_backend} storage is not configured')
 else:
-    context = ssl.create_default_context()
-    context.verify_mode = ssl.CERT_REQUIRED
-    context.check_hostname = True  # Seems to be implicit for CERT_REQUIRED but...
-    context.minimum_version = ssl.TLSVersion.TLSv1_3
-
-    ftps = ftplib.FTP_TLS(Config.ftp_host, context=context, timeout=Config.ftp_timeout)
-    ftps.login(Config.ftp_user, Config.ftp_pass)
-    ftps.prot_p()  # Require data connection to be secure (not just control connection)
-
-    ftps.cwd(Config.ftp_dir)
+    uploader = storage.Uploader(connectStorage, local_dir, Config.upload_blocksize)
 
     tprint('Checking for remote garbage')
-    remote_dirlist = MLSD(ftps)
-    for fname in remote_dirlist:
-        if fname not in ['.', '..'] and shouldRemove(fname):
+    for fname in list(uploader.remote_sizes):
+        if shouldRemove(fname):
             tprint(f'...removing remote {fname}')
-            ftps.delete(fname)
+            uploader.delete(fname)
 
     tprint('Checking if remote has any missing or incomplete files')
+    backfill_files = []
     for fname in local_dirlist:
-        path = f'{local_dir}/{fname}'
         # ignore if it's the current recording, we'll get to that, this is only about past recordings that weren't uploaded (completely)
-        if fname != timeToFilename(time.time()):
-            if fname not in remote_dirlist:
-                tprint(f'Uploading missing file {fname}')
-                with open(path, 'rb') as fp:
-                    ftps.storbinary(f'STOR {fname}', fp)
-            elif remote_dirlist[fname]['type'] != 'file':
+        if isRecording(fname) and recordingTime(fname) != filenameToTime(timeToFilename(time.time())):  # with several cameras, there is one current file per camera
+            if os.path.getmtime(f'{local_dir}/{fname}') > time.time() - Backfill.BUSY_SECONDS:
+                # Just after a time slot boundary, record.py may still be finishing the previous slot's file (e.g. with
+                # gapless_rotation, until the next segment starts). The live upload gets inotify events for that, so
+                # leave it to that one; if it was already done, the next sync.py run will pick up the rest.
                 continue
-            elif os.path.getsize(path) != int(remote_dirlist[fname]['size']):
-                tprint(f'Appending to incomplete file {fname}')
-                with open(path, 'rb') as fp:
-                    fp.seek(int(remote_dirlist[fname]['size']))
-                    ftps.storbinary(f'APPE {fname}', fp)  # append
+            missing = os.path.getsize(f'{local_dir}/{fname}') - uploader.remote_sizes.get(fname, 0)
+            if missing > 0:
+                backfill_files.append((fname, missing))
+
+    backfill_files.sort(key=lambda item: recordingTime(item[0]))
+    backfill = Backfill(backfill_files)
+    if len(backfill_files) > 0:
+        tprint(f'Uploading {len(backfill_files)} missing or incomplete files in the background')
+        backfill.start()
 
 if time.time() > starttime + (sync_restart_after_seconds / 2):
     tprint("Warning: used up more than half the time for maintenance! Should either check what's up or increase sync_restart_after\n", sys.stderr.write)
 
 tprint('Starting inotify listener')
 wm = pyinotify.WatchManager()
-notifier = pyinotify.Notifier(wm, NotifyHandler())
+handler = NotifyHandler()
+notifier = pyinotify.Notifier(wm, handler, timeout=1000)  # the timeout makes check_events() return, so we get to check the time
 wm.add_watch(local_dir, pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE)  # modify events and closed-file-that-was-open-for-writing events
-notifier.loop()
 
+if not disable_uploading:
+    upload_queue = UploadQueue()
+    worker = UploadWorker(uploader, upload_queue)
+    worker.start()
+
+if not disable_uploading:
+    registry.counter('encrocam_uploaded_bytes_total', 'Bytes uploaded, live and backfill', function=lambda: worker.uploaded() + backfill.uploaded())
+    registry.counter('encrocam_upload_retries_total', 'Failed uploads that were retried, live and backfill', function=lambda: worker.retries + backfill.retries)
+    registry.counter('encrocam_upload_connections_total', 'Connections opened for the live upload', function=worker.connectionsOpened)
+    registry.gauge('encrocam_upload_lag_bytes', 'Bytes of the current recording(s) not yet uploaded', function=uploadLag)
+    registry.gauge('encrocam_backfill_remaining_bytes', 'Bytes of past recordings still to be uploaded', function=lambda: backfill.bytes_total - backfill.uploaded())
+if Config.metrics_dir != False:
+    registry.start_writing(Config.metrics_dir, Config.metrics_interval)
+
+if Config.monitoring_url not in [None, ''] and Config.monitoring_url.strip() != '':
+    Heartbeat(lambda: handler.last_event if disable_uploading else worker.last_success).start()
+
+last_progress = time.time()
+while True:
+    if notifier.check_events():
+        notifier.read_events()
+        notifier.process_events()
+
+    if not disable_uploading and len(backfill.threads) > 0 and (time.time() > last_progress + 60 or backfill.done()):
+        tprint(backfill.progress())
+        last_progress = time.time()
+        if backfill.done():
+            backfill.threads = []  # done, stop logging progress
+
+    if time.time() > starttime + sync_restart_after_seconds:
+        if not disable_uploading:
+            backfill.stop()
+            if len(backfill.threads) > 0:
+                tprint(backfill.progress())
+            worker.stopping.set()
+            worker.join(Config.ftp_timeout * 2)  # let it finish the current upload and close the connection
+        tprint(f'Sync: time up, restarting ({stats()})')
+        sys.exit(0)